@@ -1,16 +1,246 @@
 import boto3
+import botocore
+import botocore.config
 import os
 import json
+import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# SQS limits for a single SendMessageBatch request
+SQS_MAX_BATCH_SIZE = 10
+SQS_MAX_BATCH_BYTES = 256 * 1024
+
+# Error codes SQS uses for a queue that has been deleted or never existed
+QUEUE_DOES_NOT_EXIST_CODES = ('AWS.SimpleQueueService.NonExistentQueue', 'QueueDoesNotExist')
+
+
+class ResolutionCache:
+    """
+    Time limited cache for values that are expensive to resolve from AWS, e.g. the account ID and queue URLs.
+    Lives at module level so that it survives warm Lambda invocations.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+
+    def get(self, key):
+        """
+        Returns cached value or None if the key is not cached or the entry has expired
+        :param key: cache key, e.g. queue name
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self.entries[key]
+            return None
+        return value
+
+    def set(self, key, value):
+        self.entries[key] = (value, time.monotonic() + self.ttl)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class AcknowledgementStage:
+    """
+    Collects messages received from an SQS queue and deletes them with DeleteMessageBatch in groups of 10.
+    Messages that could not be deleted are kept in unacknowledged so the caller can report them.
+    """
+    def __init__(self, sqs_client, queue_url, max_attempts=3):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.max_attempts = max_attempts
+        self.pending = []
+        self.unacknowledged = []
+        self.logger = logging.getLogger()
+
+    def add(self, data_entry):
+        """
+        Adds a message to be acknowledged, flushing the collected messages once a full batch is available
+        :param data_entry: message returned by SQS receive_message
+        """
+        self.pending.append(data_entry)
+        if len(self.pending) >= SQS_MAX_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        Deletes all collected messages from the queue, retrying entries that failed on the AWS side
+        :return: list of messages that are still unacknowledged
+        """
+        while self.pending:
+            batch = self.pending[:SQS_MAX_BATCH_SIZE]
+            self.pending = self.pending[SQS_MAX_BATCH_SIZE:]
+            for attempt in range(self.max_attempts):
+                response = self.sqs_client.delete_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[
+                        {'Id': str(i), 'ReceiptHandle': data_entry['ReceiptHandle']}
+                        for i, data_entry in enumerate(batch)
+                    ]
+                )
+                retry = []
+                for failure in response.get('Failed', []):
+                    data_entry = batch[int(failure['Id'])]
+                    self.logger.warning("Failed to acknowledge message {0}: {1}".format(
+                        data_entry.get('MessageId'), failure.get('Message', failure.get('Code'))))
+                    if failure.get('SenderFault', False):
+                        self.unacknowledged.append(data_entry)
+                    else:
+                        retry.append(data_entry)
+                batch = retry
+                if not batch:
+                    break
+            self.unacknowledged += batch
+        return self.unacknowledged
+
+
+resolution_cache = ResolutionCache(int(os.environ.get('QUEUE_CACHE_TTL', 300)))
+ACCOUNT_ID_CACHE_KEY = 'account-id'
+
+# Subscriber that stores the data in the persistent database, notified about every drain
+OUTGOING_QUEUE_ARCHIVIST = 'persistent_database_writer'
+
+# Subscribers that always receive the incoming data
+STATIC_SUBSCRIBERS = [OUTGOING_QUEUE_ARCHIVIST, 'nest-queue-outgoing-test']
+
+
+class SubscriberRegistry:
+    """
+    Resolves the subscribers that incoming data is forwarded to and caches them for the lifetime of the
+    warm container. Subscribers can be read from the opsworks:instance tags of the EC2 instances of the
+    organization, from the comma separated SUBSCRIBERS environment variable and from a static list.
+    """
+    def __init__(self, ttl, sources, static_subscribers):
+        self.ttl = ttl
+        self.sources = sources
+        self.static_subscribers = static_subscribers
+        self.subscribers = None
+        self.expires_at = 0
+
+    def get_subscribers(self, consumer):
+        """
+        Returns the cached subscribers, reloading them from the configured sources once the cache has expired
+        :param consumer: NestQueueConsumer used to look up the EC2 instances
+        :return: list of subscriber names
+        """
+        if self.subscribers is None or time.monotonic() >= self.expires_at:
+            self.subscribers = self.load_subscribers(consumer)
+            self.expires_at = time.monotonic() + self.ttl
+        return list(self.subscribers)
+
+    def load_subscribers(self, consumer):
+        subscribers = []
+        for source in self.sources:
+            if source == 'ec2':
+                subscribers += consumer.get_ec2_instances(os.environ.get('ORG', ''))
+            elif source == 'environment':
+                subscribers += [s.strip() for s in os.environ.get('SUBSCRIBERS', '').split(',') if s.strip()]
+            elif source == 'static':
+                subscribers += self.static_subscribers
+            else:
+                raise ValueError("Unknown subscriber source: {0}".format(source))
+
+        # Keep the order of the sources but forward to each subscriber only once
+        unique_subscribers = []
+        for subscriber in subscribers:
+            if subscriber not in unique_subscribers:
+                unique_subscribers.append(subscriber)
+        return unique_subscribers
+
+    def invalidate(self):
+        self.subscribers = None
+
+
+subscriber_registry = SubscriberRegistry(
+    ttl=int(os.environ.get('SUBSCRIBER_CACHE_TTL', 300)),
+    sources=[s.strip() for s in os.environ.get('SUBSCRIBER_SOURCES', 'ec2,environment,static').split(',')],
+    static_subscribers=STATIC_SUBSCRIBERS
+)
+
+
+def is_queue_does_not_exist(error):
+    """
+    Checks whether a botocore ClientError was raised because the queue does not exist
+    :param error: botocore ClientError
+    """
+    return error.response.get('Error', {}).get('Code') in QUEUE_DOES_NOT_EXIST_CODES
+
+
+# boto3 clients are created lazily and reused across warm Lambda invocations
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(service_name):
+    """
+    Returns a shared boto3 client for the given service, creating it on first use.
+    Region, connection pool size and retry behaviour are read from the environment.
+
+    :param service_name: AWS service name, e.g. 'sqs'
+    :return: boto3 client
+    """
+    client = clients.get(service_name)
+    if client is None:
+        with clients_lock:
+            client = clients.get(service_name)
+            if client is None:
+                # Every fan out worker may hold a connection of the shared client at the same time
+                max_pool_connections = max(int(os.environ.get('BOTO_MAX_POOL_CONNECTIONS', 10)),
+                                           int(os.environ.get('FANOUT_WORKERS', 1)))
+                config = botocore.config.Config(
+                    max_pool_connections=max_pool_connections,
+                    retries={
+                        'mode': os.environ.get('BOTO_RETRY_MODE', 'standard'),
+                        'max_attempts': int(os.environ.get('BOTO_MAX_ATTEMPTS', 3))
+                    }
+                )
+                region_name = os.environ.get('AWS_REGION', os.environ.get('AWS_DEFAULT_REGION'))
+                client = boto3.client(service_name, region_name=region_name, config=config)
+                clients[service_name] = client
+    return client
+
+
+# Fan out thread pools are reused across pages and warm Lambda invocations
+fanout_executors = {}
+fanout_executors_lock = threading.Lock()
+
+
+def get_fanout_executor(workers):
+    """
+    Returns a shared thread pool with the given number of workers, creating it on first use
+
+    :param workers: number of worker threads
+    :return: ThreadPoolExecutor
+    """
+    executor = fanout_executors.get(workers)
+    if executor is None:
+        with fanout_executors_lock:
+            executor = fanout_executors.get(workers)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=workers)
+                fanout_executors[workers] = executor
+    return executor
 
 
 class NestQueueConsumer:
     def __init__(self):
-        region_name = 'eu-west-1'
-        self.sns_client = boto3.client('sns', region_name=region_name)
-        self.sqs_client = boto3.client('sqs', region_name=region_name)
-        self.sts_client = boto3.client('sts', region_name=region_name)
-        self.ec2_client = boto3.client('ec2', region_name=region_name)
+        self.sns_client = get_client('sns')
+        self.sqs_client = get_client('sqs')
+        self.sts_client = get_client('sts')
+        self.ec2_client = get_client('ec2')
+
+        self.max_send_attempts = int(os.environ.get('MAX_SEND_ATTEMPTS', 3))
+        self.fanout_workers = int(os.environ.get('FANOUT_WORKERS', 1))
+        self.time_margin_ms = int(os.environ.get('TIME_MARGIN_MS', 10000))
 
         self.logger = logging.getLogger()
         self.logger.setLevel(logging.WARNING)
@@ -22,7 +252,10 @@ class NestQueueConsumer:
         Returns:\n
             account ID for the configured AWS user\n
         """
-        account_id = self.sts_client.get_caller_identity()["Account"]
+        account_id = resolution_cache.get(ACCOUNT_ID_CACHE_KEY)
+        if account_id is None:
+            account_id = self.sts_client.get_caller_identity()["Account"]
+            resolution_cache.set(ACCOUNT_ID_CACHE_KEY, account_id)
         return account_id
 
     def get_queue_url(self, queue_name):
@@ -32,11 +265,31 @@ class NestQueueConsumer:
         Returns:\n
             URL for the given queue\n
         """
-        response = self.sqs_client.get_queue_url(
-            QueueName=queue_name,
-            QueueOwnerAWSAccountId=self.get_account_id()
-        )
-        return response['QueueUrl']
+        queue_url = resolution_cache.get(queue_name)
+        if queue_url is None:
+            response = self.sqs_client.get_queue_url(
+                QueueName=queue_name,
+                QueueOwnerAWSAccountId=self.get_account_id()
+            )
+            queue_url = response['QueueUrl']
+            resolution_cache.set(queue_name, queue_url)
+        return queue_url
+
+    def get_outgoing_queue_url(self, outgoing_queue):
+        """
+        Returns the URL of an outgoing queue, creating the queue if it does not exist yet
+
+        :param outgoing_queue: name of the outgoing queue
+        :return: URL for the given queue
+        """
+        queue_url = resolution_cache.get(outgoing_queue)
+        if queue_url is None:
+            response = self.sqs_client.create_queue(
+                QueueName=outgoing_queue
+            )
+            queue_url = response['QueueUrl']
+            resolution_cache.set(outgoing_queue, queue_url)
+        return queue_url
 
     def get_outgoing_subscriptions(self, topic_arn):
         """
@@ -75,40 +328,82 @@ class NestQueueConsumer:
         Get the topic for outgoing data from Lambda queue consumer
         :return: Topic object where lambda publishes notifications about new data
         """
-        topic = self.sns_client.create_topic(
-            Name='nest-outgoing-topic-' + os.environ['ORG'].lower()
-        )
-        return topic
+        topic_name = 'nest-outgoing-topic-' + os.environ['ORG'].lower()
+        topic_arn = resolution_cache.get(topic_name)
+        if topic_arn is None:
+            topic_arn = self.sns_client.create_topic(
+                Name=topic_name
+            )['TopicArn']
+            resolution_cache.set(topic_name, topic_arn)
+        return {'TopicArn': topic_arn}
 
     def get_incoming_data(self, queue_name, n=1):
         """
-        Fetch data from SQS
+        Fetch data from SQS page by page until the queue is empty
         :param queue_name: name of the queue with incoming data
-        :param n: how many times the receive_message function is run
-        :return: returns a list of return values from AWS
-        """
-        return_set = []
-        # TODO empty the whole queue
-
-        n_messages = 1
-        while n_messages != 0:
-            response = (self.sqs_client.receive_message(
-                QueueUrl=self.get_queue_url(queue_name),
-                MaxNumberOfMessages=10,
-                WaitTimeSeconds=1
-            )
-            ).get('Messages', [])
-            n_messages = len(response)
-            return_set += response
-        return return_set
+        :param n: unused, kept for backwards compatibility
+        :return: generator that yields lists of messages returned by AWS, at most 10 messages each
+        """
+        while True:
+            try:
+                response = (self.sqs_client.receive_message(
+                    QueueUrl=self.get_queue_url(queue_name),
+                    MaxNumberOfMessages=10,
+                    WaitTimeSeconds=1
+                )
+                ).get('Messages', [])
+            except botocore.exceptions.ClientError as e:
+                if is_queue_does_not_exist(e):
+                    resolution_cache.invalidate(queue_name)
+                raise
+            if not response:
+                return
+            yield response
+
+    def get_incoming_topic(self):
+        """
+        Get the topic that triggers the Lambda queue consumer
+        :return: Topic object the consumer is subscribed to
+        """
+        topic_name = 'nest-incoming-topic-' + os.environ['ORG'].lower()
+        topic_arn = resolution_cache.get(topic_name)
+        if topic_arn is None:
+            topic_arn = self.sns_client.create_topic(
+                Name=topic_name
+            )['TopicArn']
+            resolution_cache.set(topic_name, topic_arn)
+        return {'TopicArn': topic_arn}
+
+    def retrigger(self, message):
+        """
+        Publishes the incoming notification again so that another invocation continues the drain
+        :param message: Includes the queue name of the queue that has new data available
+        """
+        topic = self.get_incoming_topic()
+        self.sns_client.publish(
+            TopicArn=topic['TopicArn'],
+            Message=json.dumps(message)
+        )
+
+    def is_out_of_time(self, context):
+        """
+        Checks whether the Lambda invocation is about to reach its timeout
+        :param context: Lambda context, or None when running outside Lambda
+        """
+        if context is None:
+            return False
+        return context.get_remaining_time_in_millis() < self.time_margin_ms
 
-    def notify_outgoing_subscribers(self, outgoing_queue, dead_letter_queue_for_outgoing):
+    def notify_outgoing_subscribers(self, outgoing_queue, dead_letter_queue_for_outgoing, message_count=None):
         """
         Send notification with information about the outgoing queue and its dead letter queue
         :param outgoing_queue: outgoing queue
         :param dead_letter_queue_for_outgoing: dead letter queue for outgoing data
+        :param message_count: optional number of messages sent to the outgoing queue
         """
         notification_message_dict = {'queue': outgoing_queue, 'dead_letter_queue': dead_letter_queue_for_outgoing}
+        if message_count is not None:
+            notification_message_dict['count'] = message_count
         notification_message = json.dumps(notification_message_dict)
 
         topic = self.get_outgoing_topic()
@@ -117,40 +412,101 @@ class NestQueueConsumer:
             Message=notification_message
         )
 
-    def acknowledge_data_entry(self, queue, data_entry):
+    def acknowledge_data_entries(self, queue, data_entries):
         """
-        Sends an ACK message to SQS to delete the message from queue
-        :param data_entry: data entry returned by SQS receive_message
-        :param queue: queue the data entry was fetched from
-        :return: AWS delete message return value
+        Deletes consumed data entries from the queue with DeleteMessageBatch
+        :param queue: queue the data entries were fetched from
+        :param data_entries: data entries returned by SQS receive_message
+        :return: list of data entries that could not be acknowledged
         """
-        response = self.sqs_client.delete_message(
-            QueueUrl=self.get_queue_url(queue),
-            ReceiptHandle=data_entry['ReceiptHandle']
-        )
-        return response
+        acknowledgements = AcknowledgementStage(self.sqs_client, self.get_queue_url(queue), self.max_send_attempts)
+        try:
+            for data_entry in data_entries:
+                acknowledgements.add(data_entry)
+            return acknowledgements.flush()
+        except botocore.exceptions.ClientError as e:
+            if is_queue_does_not_exist(e):
+                resolution_cache.invalidate(queue)
+            raise
 
-    def redirect_data_to_subscriber(self, subscriber, incoming_queue, dead_letter_queue_for_incoming, data_entry):
+    @staticmethod
+    def batch_data_entries(data_entries):
+        """
+        Splits data entries into chunks that fit in a single SQS SendMessageBatch request
+        :param data_entries: data entries returned by SQS receive_message
+        :return: list of lists of data entries, each at most 10 entries and 256 KB
+        """
+        batches = []
+        batch = []
+        batch_bytes = 0
+        for data_entry in data_entries:
+            entry_bytes = len(data_entry['Body'].encode('utf-8'))
+            if batch and (len(batch) == SQS_MAX_BATCH_SIZE or batch_bytes + entry_bytes > SQS_MAX_BATCH_BYTES):
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(data_entry)
+            batch_bytes += entry_bytes
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def send_data_entries(self, queue_url, data_entries):
+        """
+        Sends data entries to a queue with SendMessageBatch, retrying entries that failed on the AWS side
+        :param queue_url: URL of the queue to send the data to
+        :param data_entries: data entries returned by SQS receive_message
+        :return: list of data entries that could not be sent
+        """
+        failed_entries = []
+        for batch in self.batch_data_entries(data_entries):
+            pending = batch
+            for attempt in range(self.max_send_attempts):
+                entries = [
+                    {'Id': str(i), 'MessageBody': data_entry['Body']}
+                    for i, data_entry in enumerate(pending)
+                ]
+                resp = self.sqs_client.send_message_batch(
+                    QueueUrl=queue_url,
+                    Entries=entries
+                )
+                self.logger.info(resp)
+
+                retry = []
+                for failure in resp.get('Failed', []):
+                    data_entry = pending[int(failure['Id'])]
+                    self.logger.warning("Failed to send message {0}: {1}".format(
+                        data_entry.get('MessageId'), failure.get('Message', failure.get('Code'))))
+                    if failure.get('SenderFault', False):
+                        failed_entries.append(data_entry)
+                    else:
+                        retry.append(data_entry)
+                pending = retry
+                if not pending:
+                    break
+            failed_entries += pending
+        return failed_entries
+
+    def redirect_data_to_subscriber(self, subscriber, incoming_queue, dead_letter_queue_for_incoming, data_entries):
         """
         Sends data fetched from the incoming queue to the subscriber and data type specific queues
         :param subscriber: Subscriber to redirect data to
         :param incoming_queue: Queue from where Lambda fetched the data
         :param dead_letter_queue_for_incoming: Queue for letters that the Lambda consumer could not handle
-        :param data_entry: Data entry to be forwarded
-        :return:
+        :param data_entries: Data entries to be forwarded
+        :return: list of data entries that could not be forwarded
         """
         outgoing_queue = self.get_outgoing_queue(subscriber, incoming_queue)
-        dead_letter_queue_for_outgoing = self.get_dead_letter_queue_for_outgoing(
-            subscriber, dead_letter_queue_for_incoming)
-        outgoing_queue_url = self.sqs_client.create_queue(
-            QueueName=outgoing_queue
-        )
-        resp = self.sqs_client.send_message(
-            QueueUrl=outgoing_queue_url['QueueUrl'],
-            MessageBody=data_entry['Body']
-        )
-        self.logger.info("Sending to " + outgoing_queue)
-        self.logger.info(resp)
+        self.logger.info("Sending {0} entries to {1}".format(len(data_entries), outgoing_queue))
+        try:
+            return self.send_data_entries(self.get_outgoing_queue_url(outgoing_queue), data_entries)
+        except botocore.exceptions.ClientError as e:
+            if not is_queue_does_not_exist(e):
+                raise
+            # The cached queue was deleted, create it again and resend
+            self.logger.warning("Outgoing queue {0} does not exist, recreating it".format(outgoing_queue))
+            resolution_cache.invalidate(outgoing_queue)
+            return self.send_data_entries(self.get_outgoing_queue_url(outgoing_queue), data_entries)
 
     def get_ec2_instances(self, task):
         """
@@ -164,51 +520,187 @@ class NestQueueConsumer:
         args = {}
         args['Filters'] = [{'Name': 'tag:meerkat:task', 'Values': [task]}]
 
-        # Get instance data
-        reservations = self.ec2_client.describe_instances(**args)['Reservations']
+        # Get instance data, EC2 returns the reservations in pages
+        reservations = []
+        response = self.ec2_client.describe_instances(**args)
+        reservations += response['Reservations']
+        next_token = response.get('NextToken', None)
+        while next_token is not None:
+            response = self.ec2_client.describe_instances(NextToken=next_token, **args)
+            next_token = response.get('NextToken', None)
+            reservations += response['Reservations']
 
         # Structure the data and return.
         deploy_ids = []
         for res in reservations:
             for instance in res['Instances']:
-                for tag in instance['Tags']:
+                for tag in instance.get('Tags', []):
                     if tag['Key'] == 'opsworks:instance':
                         deploy_ids.append(tag['Value'])
         return deploy_ids
 
-    def distribute_data(self, message):
+    def forward_to_subscriber(self, subscriber, incoming_queue, dead_letter_queue_for_incoming, data_entries):
         """
-        Main function to distribute data from incoming queue to subscriber queues
-        :param message: Includes the queue name of the queue that has new data available
+        Forwards data entries to a single subscriber, treating AWS errors as a failure of every entry
+        :return: list of data entries that could not be forwarded
+        """
+        try:
+            return self.redirect_data_to_subscriber(
+                subscriber, incoming_queue, dead_letter_queue_for_incoming, data_entries)
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError):
+            self.logger.exception("Failed to forward data entries to {0}".format(subscriber))
+            return list(data_entries)
+
+    def fan_out(self, subscriptions, incoming_queue, dead_letter_queue_for_incoming, data_entries):
+        """
+        Forwards data entries to every subscriber. With FANOUT_WORKERS greater than 1 the subscribers are
+        sent to in parallel from a bounded thread pool that is shared across warm invocations.
+        :param subscriptions: list of subscribers
+        :param incoming_queue: Queue from where Lambda fetched the data
+        :param dead_letter_queue_for_incoming: Queue for letters that the Lambda consumer could not handle
+        :param data_entries: Data entries to be forwarded
+        :return: dict of subscriber to list of data entries that could not be forwarded to it
+        """
+        args = (incoming_queue, dead_letter_queue_for_incoming, data_entries)
+        if self.fanout_workers <= 1 or len(subscriptions) <= 1:
+            return {s: self.forward_to_subscriber(s, *args) for s in subscriptions}
+
+        executor = get_fanout_executor(self.fanout_workers)
+        futures = {s: executor.submit(self.forward_to_subscriber, s, *args) for s in subscriptions}
+        return {s: future.result() for s, future in futures.items()}
+
+    def forward_page(self, subscriptions, incoming_queue, dead_letter_queue_for_incoming, data_entries):
+        """
+        Forwards one page of data entries to the subscribers
+        :return: tuple of the data entries that reached every subscriber and the number of data entries
+            that were forwarded to the archivist
         """
-        outgoing_queue_archivist = 'persistent_database_writer'
+        failed_message_ids = set()
+        archived_count = 0
+        failures = self.fan_out(subscriptions, incoming_queue, dead_letter_queue_for_incoming, data_entries)
+        for subscriber, failed_entries in failures.items():
+            failed_message_ids.update(data_entry['MessageId'] for data_entry in failed_entries)
+            if subscriber == OUTGOING_QUEUE_ARCHIVIST:
+                archived_count = len(data_entries) - len(failed_entries)
+
+        if failed_message_ids:
+            self.logger.warning("Failed to forward {0} data entries".format(len(failed_message_ids)))
+        forwarded_data = [
+            data_entry for data_entry in data_entries if data_entry['MessageId'] not in failed_message_ids
+        ]
+        return forwarded_data, archived_count
+
+    def acknowledge_forwarded_data(self, incoming_queue, forwarded_data):
+        """
+        Acknowledges the data entries of one page that reached every subscriber
+        """
+        # Entries that did not reach every subscriber are left in the queue for redelivery
+        unacknowledged = self.acknowledge_data_entries(incoming_queue, forwarded_data)
+        if unacknowledged:
+            self.logger.warning("Failed to acknowledge {0} data entries".format(len(unacknowledged)))
+
+    def notify_archivist(self, incoming_queue, dead_letter_queue_for_incoming, archived_count):
+        """
+        Notifies the archivist about data forwarded to its queue, one notification per drain is enough
+        """
+        if archived_count > 0:
+            outgoing_queue = self.get_outgoing_queue(OUTGOING_QUEUE_ARCHIVIST, incoming_queue)
+            dead_letter_queue_for_outgoing = self.get_dead_letter_queue_for_outgoing(
+                OUTGOING_QUEUE_ARCHIVIST, dead_letter_queue_for_incoming)
+            self.notify_outgoing_subscribers(outgoing_queue, dead_letter_queue_for_outgoing, archived_count)
+
+    def distribute_records(self, incoming_queue, data_entries):
+        """
+        Forwards messages delivered by an SQS event source to the subscriber queues. The messages are not
+        deleted here, the event source mapping deletes every message that is not reported as failed.
+        :param incoming_queue: Queue the event source mapping read the messages from
+        :param data_entries: messages in the receive_message format
+        :return: list of data entries that did not reach every subscriber
+        """
+        subscriptions = subscriber_registry.get_subscribers(self)
+        dead_letter_queue_for_incoming = os.environ.get('DEAD_LETTER_QUEUE', incoming_queue + '-dead-letter')
+
+        forwarded_data, archived_count = self.forward_page(
+            subscriptions, incoming_queue, dead_letter_queue_for_incoming, data_entries)
+        self.notify_archivist(incoming_queue, dead_letter_queue_for_incoming, archived_count)
+
+        self.logger.info("Handled {0} data entries for {1} subscribers".format(len(data_entries), len(subscriptions)))
+        forwarded_message_ids = set(data_entry['MessageId'] for data_entry in forwarded_data)
+        return [data_entry for data_entry in data_entries if data_entry['MessageId'] not in forwarded_message_ids]
 
-        subscriptions = self.get_ec2_instances(os.environ.get('ORG', ''))
-        subscriptions.append(outgoing_queue_archivist)
-        subscriptions.append("nest-queue-outgoing-test")
+    def distribute_data(self, message, context=None):
+        """
+        Main function to distribute data from incoming queue to subscriber queues. Every received page is
+        forwarded and acknowledged before the next one is fetched. The drain stops before the Lambda
+        timeout and triggers a new invocation if data may remain in the queue.
+        :param message: Includes the queue name of the queue that has new data available
+        :param context: Lambda context used to read the remaining time
+        :return: True if the drain was stopped before the queue was empty
+        """
+        subscriptions = subscriber_registry.get_subscribers(self)
 
         incoming_queue = message['queue']
         dead_letter_queue_for_incoming = message['dead-letter-queue']
-        incoming_data = self.get_incoming_data(incoming_queue)
 
         self.logger.info("Incoming queue: " + incoming_queue)
         for s in subscriptions:
             self.logger.info(s)
-        
-        sub_len = len(subscriptions)
-        data_len = len(incoming_data)
-
-        for data_entry in incoming_data:
-            for subscriber in subscriptions:
-                self.redirect_data_to_subscriber(subscriber, incoming_queue, dead_letter_queue_for_incoming, data_entry)
-            outgoing_queue = self.get_outgoing_queue(outgoing_queue_archivist, incoming_queue)
-            dead_letter_queue_for_outgoing = self.get_dead_letter_queue_for_outgoing(
-                outgoing_queue_archivist, dead_letter_queue_for_incoming)
-            self.notify_outgoing_subscribers(outgoing_queue, dead_letter_queue_for_outgoing)
-
-            self.acknowledge_data_entry(incoming_queue, data_entry)
-        self.logger.info("Handled {0} data entries for {1} subscribers".format(data_len, sub_len))
 
+        data_len = 0
+        archived_count = 0
+        work_remaining = False
+        try:
+            for data_entries in self.get_incoming_data(incoming_queue):
+                data_len += len(data_entries)
+                forwarded_data, page_archived_count = self.forward_page(
+                    subscriptions, incoming_queue, dead_letter_queue_for_incoming, data_entries)
+                archived_count += page_archived_count
+                self.acknowledge_forwarded_data(incoming_queue, forwarded_data)
+                if self.is_out_of_time(context):
+                    work_remaining = True
+                    break
+        finally:
+            # Pages already forwarded to the archivist are announced even if a later page fails
+            self.notify_archivist(incoming_queue, dead_letter_queue_for_incoming, archived_count)
+
+        if work_remaining:
+            self.logger.warning("Running out of time, triggering a new drain of " + incoming_queue)
+            self.retrigger(message)
+
+        self.logger.info("Handled {0} data entries for {1} subscribers".format(data_len, len(subscriptions)))
+        return work_remaining
+
+
+def sqs_records_to_data_entries(event):
+    """
+    Converts the records of an SQS event source batch into the format returned by receive_message,
+    grouped by the queue they were read from
+    :param event: Lambda event with SQS records
+    :return: dict of queue name to list of messages
+    """
+    data_entries = {}
+    for record in event.get('Records', []):
+        queue = record['eventSourceARN'].split(':')[-1]
+        data_entries.setdefault(queue, []).append({
+            'MessageId': record['messageId'],
+            'ReceiptHandle': record['receiptHandle'],
+            'Body': record['body'],
+            'Attributes': record.get('attributes', {})
+        })
+    return data_entries
+
+
+def get_notifications(event):
+    """
+    Reads the notifications from every SNS record in the event and merges the ones that point to the same queue
+    :param event: Lambda event with SNS records
+    :return: list of notification messages, one per queue
+    """
+    notifications = {}
+    for record in event.get('Records', []):
+        message = json.loads(record['Sns']['Message'])
+        notifications.setdefault(message['queue'], message)
+    return list(notifications.values())
 
 
 def lambda_handler(event, context):
@@ -219,7 +711,27 @@ def lambda_handler(event, context):
     :return: returns information about where the data was forwarded to
     """
     consumer = NestQueueConsumer()
-    message = json.loads(event['Records'][0]['Sns']['Message'])
-    consumer.distribute_data(message)
+    for message in get_notifications(event):
+        # Queues that cannot be drained in this invocation are handed over to a new one
+        if consumer.is_out_of_time(context):
+            consumer.retrigger(message)
+            continue
+        consumer.distribute_data(message, context)
 
     return 'Lambda run for ' + os.environ['ORG']
+
+
+def sqs_lambda_handler(event, context):
+    """
+    Distributes messages delivered directly by an SQS event source mapping to the subscribers.
+    Requires ReportBatchItemFailures on the event source mapping so that only failed messages are redelivered.
+    :param event: SQS event source batch
+    :param context:
+    :return: partial batch response listing the messages that did not reach every subscriber
+    """
+    consumer = NestQueueConsumer()
+    failed_entries = []
+    for incoming_queue, data_entries in sqs_records_to_data_entries(event).items():
+        failed_entries += consumer.distribute_records(incoming_queue, data_entries)
+
+    return {'batchItemFailures': [{'itemIdentifier': data_entry['MessageId']} for data_entry in failed_entries]}
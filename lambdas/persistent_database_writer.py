@@ -1,19 +1,378 @@
 import boto3
+import botocore.config
+import contextlib
+import hashlib
 import os
 import json
+import re
+import time
 import uuid
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Full, Queue
 import psycopg2
+import psycopg2.errorcodes
+import psycopg2.extensions
+import psycopg2.extras
+
+# SQS limit for a single SendMessageBatch or DeleteMessageBatch request
+SQS_MAX_BATCH_SIZE = 10
+
+# Drain summaries are logged regardless of LOGGING_LEVEL, which defaults to ERROR
+summary_logger = logging.getLogger('persistent_database_writer.summary')
+summary_logger.setLevel(logging.WARNING)
+
+# Database errors caused by the content of a single row rather than by the database, its schema or the code
+DATA_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError)
+
+
+def is_missing_table(error):
+    """
+    Checks whether a database error was raised because the table of the form does not exist
+    :param error: psycopg2 Error
+    """
+    return getattr(error, 'pgcode', None) == psycopg2.errorcodes.UNDEFINED_TABLE
+
+
+def is_data_error(error):
+    """
+    Checks whether a database error was caused by the message that was written, so that the message
+    can be isolated instead of failing the whole batch. A missing form table only affects the messages
+    of that form and is treated the same way.
+    :param error: psycopg2 Error
+    """
+    return isinstance(error, DATA_ERRORS) or is_missing_table(error)
+
+
+# Fields that carry the instance ID of a record, in order of preference
+INSTANCE_ID_FIELDS = ('meta/instanceID', 'instanceID', '*meta-instance-id*')
+
+
+def get_instance_id(record):
+    """
+    Returns the instance ID of a submitted record
+
+    :param record: dictionary with the data of one record
+    :return: instance ID, or None if the record has none
+    """
+    if not isinstance(record, dict):
+        return None
+    for field in INSTANCE_ID_FIELDS:
+        if record.get(field):
+            return record[field]
+    return None
+
+
+# boto3 clients are created lazily and reused across warm Lambda invocations
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(service_name):
+    """
+    Returns a shared boto3 client for the given service, creating it on first use.
+    Region, connection pool size and retry behaviour are read from the environment.
+
+    :param service_name: AWS service name, e.g. 'sqs'
+    :return: boto3 client
+    """
+    client = clients.get(service_name)
+    if client is None:
+        with clients_lock:
+            client = clients.get(service_name)
+            if client is None:
+                config = botocore.config.Config(
+                    max_pool_connections=int(os.environ.get('BOTO_MAX_POOL_CONNECTIONS', 10)),
+                    retries={
+                        'mode': os.environ.get('BOTO_RETRY_MODE', 'standard'),
+                        'max_attempts': int(os.environ.get('BOTO_MAX_ATTEMPTS', 3))
+                    }
+                )
+                region_name = os.environ.get('AWS_REGION', os.environ.get('AWS_DEFAULT_REGION'))
+                client = boto3.client(service_name, region_name=region_name, config=config)
+                clients[service_name] = client
+    return client
+
+
+class AcknowledgementStage:
+    """
+    Collects messages received from an SQS queue and deletes them with DeleteMessageBatch in groups of 10.
+    Messages that could not be deleted are kept in unacknowledged so the caller can report them.
+    With auto_flush disabled messages are only deleted when flush is called.
+    """
+    def __init__(self, sqs_client, queue_url, max_attempts=3, auto_flush=True):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.max_attempts = max_attempts
+        self.auto_flush = auto_flush
+        self.pending = []
+        self.unacknowledged = []
+        self.logger = logging.getLogger()
+
+    def add(self, data_entry):
+        """
+        Adds a message to be acknowledged, flushing the collected messages once a full batch is available
+        :param data_entry: message returned by SQS receive_message
+        """
+        self.pending.append(data_entry)
+        if self.auto_flush and len(self.pending) >= SQS_MAX_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        Deletes all collected messages from the queue, retrying entries that failed on the AWS side
+        :return: list of messages that are still unacknowledged
+        """
+        while self.pending:
+            batch = self.pending[:SQS_MAX_BATCH_SIZE]
+            self.pending = self.pending[SQS_MAX_BATCH_SIZE:]
+            for attempt in range(self.max_attempts):
+                response = self.sqs_client.delete_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[
+                        {'Id': str(i), 'ReceiptHandle': data_entry['ReceiptHandle']}
+                        for i, data_entry in enumerate(batch)
+                    ]
+                )
+                retry = []
+                for failure in response.get('Failed', []):
+                    data_entry = batch[int(failure['Id'])]
+                    self.logger.warning("Failed to acknowledge message {0}: {1}".format(
+                        data_entry.get('MessageId'), failure.get('Message', failure.get('Code'))))
+                    if failure.get('SenderFault', False):
+                        self.unacknowledged.append(data_entry)
+                    else:
+                        retry.append(data_entry)
+                batch = retry
+                if not batch:
+                    break
+            self.unacknowledged += batch
+        return self.unacknowledged
+
+
+class DatabaseConnectionHolder:
+    """
+    Keeps connections to the persistent database open across warm Lambda invocations and in long-lived workers.
+    A connection is checked with a cheap query before it is handed out and reopened transparently after a
+    server side timeout. At most pool_size connections are in use at the same time.
+    """
+    def __init__(self, connect, pool_size=1):
+        self.connect = connect
+        self.idle = []
+        self.lock = threading.Lock()
+        self.semaphore = threading.BoundedSemaphore(pool_size)
+        self.logger = logging.getLogger()
+
+    @staticmethod
+    def is_alive(db_conn):
+        """
+        Checks that the connection is still usable
+        :param db_conn: psycopg2 connection
+        """
+        if db_conn.closed:
+            return False
+        try:
+            with db_conn.cursor() as db_cur:
+                db_cur.execute('SELECT 1;')
+            db_conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    @staticmethod
+    def close_quietly(db_conn):
+        try:
+            db_conn.close()
+        except psycopg2.Error:
+            pass
+
+    def acquire(self):
+        """
+        Returns a live connection, reusing an idle one when possible
+        :return: psycopg2 connection
+        """
+        self.semaphore.acquire()
+        try:
+            while True:
+                with self.lock:
+                    db_conn = self.idle.pop() if self.idle else None
+                if db_conn is None:
+                    return self.connect()
+                if self.is_alive(db_conn):
+                    return db_conn
+                self.logger.info("Database connection was closed by the server, reconnecting")
+                self.close_quietly(db_conn)
+        except Exception:
+            self.semaphore.release()
+            raise
+
+    def release(self, db_conn, discard=False):
+        """
+        Returns a connection to the holder, closing it if it is broken
+        :param db_conn: psycopg2 connection
+        :param discard: close the connection instead of keeping it for reuse
+        """
+        try:
+            if not discard and not db_conn.closed:
+                if db_conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    db_conn.rollback()
+                with self.lock:
+                    self.idle.append(db_conn)
+            else:
+                self.close_quietly(db_conn)
+        except psycopg2.Error:
+            self.close_quietly(db_conn)
+        finally:
+            self.semaphore.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Context manager that acquires a connection and returns it to the holder afterwards
+        """
+        db_conn = self.acquire()
+        try:
+            yield db_conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.release(db_conn, discard=True)
+            raise
+        except BaseException:
+            self.release(db_conn)
+            raise
+        else:
+            self.release(db_conn)
+
+    def close_all(self):
+        """
+        Closes all idle connections
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for db_conn in idle:
+            self.close_quietly(db_conn)
+
+
+# Errors raised when two writers create the same table or index at the same time
+DUPLICATE_OBJECT_CODES = (psycopg2.errorcodes.UNIQUE_VIOLATION, psycopg2.errorcodes.DUPLICATE_TABLE,
+                          psycopg2.errorcodes.DUPLICATE_OBJECT)
+
+
+class FormSchemaManager:
+    """
+    Creates the table of a form the first time the form is seen. Tables that are known to exist are cached
+    for the lifetime of the container, so existence is checked at most once per form after a cold start.
+    A table created by this writer only becomes known once the transaction that created it is committed.
+    """
+    # Form IDs are used as unquoted table names, so they must be plain SQL identifiers
+    FORM_ID_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]{0,62}$')
+
+    def __init__(self):
+        self.known_tables = set()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.logger = logging.getLogger()
+
+    def validate_form_id(self, form_id):
+        """
+        Checks that a form ID can safely be used as a table name
+        :param form_id: form ID from a message
+        :raises ValueError: if the form ID is not a valid identifier
+        """
+        if not isinstance(form_id, str) or not self.FORM_ID_PATTERN.match(form_id):
+            raise ValueError("Invalid form ID {0!r}".format(form_id))
+
+    def pending_tables(self):
+        if not hasattr(self.local, 'pending'):
+            self.local.pending = set()
+        return self.local.pending
+
+    def ensure_table(self, db_cur, form_id, content_hash=False):
+        """
+        Creates the table of a form with its index unless it already exists. Existing tables are never
+        altered or indexed here, as that would lock them for the whole write transaction; changes to them
+        belong in a migration. Each DDL statement runs in its own savepoint, and a table that a concurrent
+        writer created first counts as created.
+
+        :param db_cur: database cursor
+        :param form_id: form ID, used as the table name
+        :param content_hash: create the table with the DATA_HASH column
+        """
+        self.validate_form_id(form_id)
+        table = form_id.lower()
+        with self.lock:
+            if table in self.known_tables:
+                return
+        if table in self.pending_tables():
+            return
+
+        db_cur.execute('SELECT to_regclass(%s);', (form_id,))
+        if db_cur.fetchone()[0] is not None:
+            with self.lock:
+                self.known_tables.add(table)
+            return
+
+        columns = 'UUID VARCHAR PRIMARY KEY, DATA JSONB NOT NULL'
+        if content_hash:
+            columns += ', DATA_HASH TEXT'
+        statements = [
+            'CREATE TABLE {0} ({1});'.format(form_id, columns),
+            'CREATE INDEX {0}_data_idx ON {0} USING GIN (DATA jsonb_path_ops);'.format(form_id)
+        ]
+        for statement in statements:
+            db_cur.execute('SAVEPOINT create_table;')
+            try:
+                db_cur.execute(statement)
+            except psycopg2.Error as e:
+                db_cur.execute('ROLLBACK TO SAVEPOINT create_table;')
+                db_cur.execute('RELEASE SAVEPOINT create_table;')
+                if e.pgcode not in DUPLICATE_OBJECT_CODES:
+                    raise
+                # The writer that created the table first also creates its index
+                self.logger.info("Table {0} was provisioned concurrently: {1}".format(table, str(e).strip()))
+                break
+            db_cur.execute('RELEASE SAVEPOINT create_table;')
+        self.pending_tables().add(table)
+
+    def commit(self):
+        """
+        Marks the tables created in the committed transaction of this thread as known
+        """
+        pending = self.pending_tables()
+        if pending:
+            self.logger.info("Provisioned tables {0}".format(', '.join(sorted(pending))))
+            with self.lock:
+                self.known_tables |= pending
+            pending.clear()
+
+    def rollback(self):
+        """
+        Forgets the tables created in the rolled back transaction of this thread
+        """
+        self.pending_tables().clear()
+
+    def clear(self):
+        with self.lock:
+            self.known_tables.clear()
 
 
 class PersistentDatabaseWriter:
     def __init__(self):
-        region_name = 'eu-west-1'
-        self.sns_client = boto3.client('sns', region_name=region_name)
-        self.sqs_client = boto3.client('sqs', region_name=region_name)
+        self.sns_client = get_client('sns')
+        self.sqs_client = get_client('sqs')
 
         self.max_number_of_messages = int(os.environ.get('MAX_NUMBER_OF_MESSAGES', 10))
         self.call_again = False
+        self.time_margin_ms = int(os.environ.get('TIME_MARGIN_MS', 10000))
+        self.receive_workers = int(os.environ.get('RECEIVE_WORKERS', 1))
+        self.pipeline_depth = int(os.environ.get('PIPELINE_DEPTH', 0))
+        self.handled_count = 0
+        self.dead_letter_count = 0
+        self.bulk_write = os.environ.get('BULK_WRITE', 'false').lower() == 'true'
+        self.duplicate_count = 0
+        self.content_hash = os.environ.get('CONTENT_HASH', 'false').lower() == 'true'
+        self.skipped_write_count = 0
+        self.create_tables = os.environ.get('CREATE_TABLES', 'false').lower() == 'true'
 
         log_level_ = str(os.environ.get('LOGGING_LEVEL', 'ERROR'))
         self.logger = logging.getLogger()
@@ -54,53 +413,153 @@ class PersistentDatabaseWriter:
         )
         return response['QueueUrl']
 
-    def fetch_data_from_queue(self, queue):
+    def fetch_data_from_queue(self, queue, max_messages=SQS_MAX_BATCH_SIZE, queue_url=None):
         """
         Polls messages from SQS queue
 
         :param queue: SQS queue name
-        :return: returns 1 to 10 messages from SQS as set by max_number_of_messages
+        :param max_messages: maximum number of messages to receive, SQS returns at most 10
+        :param queue_url: URL of the queue if it is already resolved
+        :return: returns 1 to 10 messages from SQS
         """
 
         response = (self.sqs_client.receive_message(
-            QueueUrl=self.get_queue_url(queue),
-            MaxNumberOfMessages=min(self.max_number_of_messages, 10),
-            WaitTimeSeconds=1
+            QueueUrl=queue_url or self.get_queue_url(queue),
+            MaxNumberOfMessages=min(max_messages, SQS_MAX_BATCH_SIZE),
+            WaitTimeSeconds=1,
+            AttributeNames=['SentTimestamp']
         )
         ).get('Messages', [])
 
         return response
 
-    def write_to_db(self, db_cur, data_entry):
+    def get_record_row(self, record):
         """
-        Writes data entry to database
+        Builds the database row for one record, keyed by its instance ID
+
+        :param record: dictionary with the data of one record
+        :return: tuple of the row UUID and the JSON data, followed by the SHA-256 of the data in content hash mode
+        """
+        data = json.dumps(record)
+        uuid_new = get_instance_id(record) or str(uuid.uuid4())
+        if self.content_hash:
+            return uuid_new, data, hashlib.sha256(data.encode('utf-8')).hexdigest()
+        return uuid_new, data
+
+    def get_rows(self, data_entry):
+        """
+        Builds the database rows for a data entry. Upload payloads carry a list of records in data,
+        each of them is stored in its own row.
 
-        :param db: database object
         :param data_entry: data to enter
+        :return: list of rows as returned by get_record_row
         """
-        data_dict = data_entry.get('data', {})
-        data = json.dumps(data_dict)
+        data = data_entry.get('data', {})
+        if isinstance(data, list):
+            return [self.get_record_row(record) for record in data]
+        return [self.get_record_row(data)]
 
-        insert_statement = 'INSERT INTO {0} (UUID, DATA) VALUES (%s, %s) ON CONFLICT (UUID) DO UPDATE SET DATA=%s WHERE {0}.UUID=%s;'.format(data_entry['formId'])
-        self.logger.debug(insert_statement)
+    def get_rows_by_form(self, data_entries):
+        """
+        Groups the rows of data entries by form. A row that appears more than once is only kept with its last
+        data, as one upsert statement cannot update the same row twice.
 
-        uuid_new = data_dict.get('meta/instanceID', str(uuid.uuid4()))
-        db_cur.execute(insert_statement, (uuid_new, data, data, uuid_new))
+        :param data_entries: data to enter
+        :return: dictionary of form ID to list of rows
+        """
+        rows_by_form = {}
+        for data_entry in data_entries:
+            form_rows = rows_by_form.setdefault(data_entry['formId'], {})
+            for row in self.get_rows(data_entry):
+                form_rows[row[0]] = row
+        return {form_id: list(form_rows.values()) for form_id, form_rows in rows_by_form.items()}
 
-    def acknowledge_messages(self, queue, data_entry):
+    def get_upsert_statement(self, form_id, values):
         """
-        Acknowledges and deletes messages that were received from SQS
+        Builds the upsert statement for a form table. In content hash mode an existing row is only updated
+        when the hash of the new data differs from the stored DATA_HASH.
 
-        :param queue: SQS queue name
-        :param data_entry: Message payload from SQS queue
-        :return: returns the response
+        :param form_id: form ID, used as the table name
+        :param values: VALUES placeholder for the rows
+        :return: SQL statement
         """
-        response = self.sqs_client.delete_message(
-            QueueUrl=self.get_queue_url(queue),
-            ReceiptHandle=data_entry['ReceiptHandle']
-        )
+        form_schemas.validate_form_id(form_id)
+        if self.content_hash:
+            return ('INSERT INTO {0} (UUID, DATA, DATA_HASH) VALUES {1} ON CONFLICT (UUID) DO UPDATE '
+                    'SET DATA=EXCLUDED.DATA, DATA_HASH=EXCLUDED.DATA_HASH '
+                    'WHERE {0}.DATA_HASH IS DISTINCT FROM EXCLUDED.DATA_HASH;').format(form_id, values)
+        return 'INSERT INTO {0} (UUID, DATA) VALUES {1} ON CONFLICT (UUID) DO UPDATE SET DATA=EXCLUDED.DATA;'.format(
+            form_id, values)
 
-        return response
+    def count_skipped_writes(self, db_cur, row_count):
+        """
+        Counts rows that were not updated because their content hash did not change
+
+        :param db_cur: database cursor the upsert was run with
+        :param row_count: number of rows in the upsert
+        """
+        if self.content_hash:
+            skipped = row_count - db_cur.rowcount
+            if skipped > 0:
+                self.skipped_write_count += skipped
+                self.logger.info("Skipped {0} unchanged rows".format(skipped))
+
+    def prepare_form_table(self, db_cur, form_id):
+        """
+        Makes sure the table of a form exists before it is written to, if table creation is enabled
+
+        :param db_cur: database cursor
+        :param form_id: form ID, used as the table name
+        """
+        if self.create_tables:
+            form_schemas.ensure_table(db_cur, form_id, self.content_hash)
+        else:
+            form_schemas.validate_form_id(form_id)
+
+    def commit(self, db_conn):
+        db_conn.commit()
+        form_schemas.commit()
+
+    def rollback(self, db_conn):
+        form_schemas.rollback()
+        db_conn.rollback()
+
+    def write_to_db(self, db_cur, data_entry):
+        """
+        Writes data entry to database. Entries with several records are written with one multi-row upsert.
+
+        :param db: database object
+        :param data_entry: data to enter
+        """
+        for form_id, rows in self.get_rows_by_form([data_entry]).items():
+            if not rows:
+                continue
+            if len(rows) == 1:
+                row = rows[0]
+                insert_statement = self.get_upsert_statement(form_id, '(' + ', '.join(['%s'] * len(row)) + ')')
+                self.logger.debug(insert_statement)
+                db_cur.execute(insert_statement, row)
+            else:
+                insert_statement = self.get_upsert_statement(form_id, '%s')
+                self.logger.debug(insert_statement)
+                psycopg2.extras.execute_values(db_cur, insert_statement, rows, page_size=len(rows))
+            self.count_skipped_writes(db_cur, len(rows))
+
+    def write_batch_to_db(self, db_cur, data_entries):
+        """
+        Writes a batch of data entries to database with one multi-row upsert per form
+
+        :param db_cur: database cursor
+        :param data_entries: data to enter
+        """
+        for form_id, rows in self.get_rows_by_form(data_entries).items():
+            if not rows:
+                continue
+            insert_statement = self.get_upsert_statement(form_id, '%s')
+            self.logger.debug(insert_statement)
+            # A single page keeps the whole form group in one statement
+            psycopg2.extras.execute_values(db_cur, insert_statement, rows, page_size=len(rows))
+            self.count_skipped_writes(db_cur, len(rows))
 
     def notify_outgoing_topic(self, topic, message):
         """
@@ -115,55 +574,512 @@ class PersistentDatabaseWriter:
             Message=json.dumps(message)
         )
 
-    def store_data_entries(self):
+    @staticmethod
+    def connect_to_db():
         """
-        Main function to call functions
+        Opens a connection to the persistent database configured in the environment
 
-        :return: binary value whether the Lambda function should be launched again
+        :return: psycopg2 connection
         """
+        return psycopg2.connect(dbname=os.environ['DB_NAME'],
+                                user=os.environ['DB_USER'],
+                                password=os.environ['DB_PW'],
+                                host=os.environ['DB_HOST'],
+                                port=os.environ.get('DB_PORT', '5432'))
 
-        nest_outgoing_queue = os.environ['PERSISTENT_DATABASE_WRITER_QUEUE']
-        self.logger.info("Fetching data from queue {0}".format(nest_outgoing_queue))
+    @staticmethod
+    def get_submission_key(data_entry):
+        """
+        Returns the key that identifies the submission carried by a message
 
-        data_entries = self.fetch_data_from_queue(nest_outgoing_queue)
+        :param data_entry: message received from SQS
+        :return: tuple of formId and the instance IDs of its records, or None if a record has no instance ID
+        """
+        try:
+            body = json.loads(data_entry['Body'])
+            data = body.get('data', {})
+            instance_ids = [get_instance_id(record) for record in (data if isinstance(data, list) else [data])]
+            return (body['formId'],) + tuple(instance_ids) if instance_ids and all(instance_ids) else None
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None
 
-        if len(data_entries) > 0:
-            db_conn = psycopg2.connect(dbname=os.environ['DB_NAME'],
-                                       user=os.environ['DB_USER'],
-                                       password=os.environ['DB_PW'],
-                                       host=os.environ['DB_HOST'],
-                                       port=os.environ.get('DB_PORT', '5432'))
-            db_cur = db_conn.cursor()
-        else:
+    def group_duplicates(self, data_entries):
+        """
+        Groups messages that carry the same submission (formId and instance IDs). The last write wins: the
+        message with the latest SQS SentTimestamp, or the one received last on a tie, is the last in its group
+        and is the only one written to the database. Every message of a group is acknowledged with it.
+
+        :param data_entries: messages received from SQS
+        :return: list of groups of messages in the order of their first message
+        """
+        groups = {}
+        for position, data_entry in enumerate(data_entries):
+            key = self.get_submission_key(data_entry) or ('message', data_entry['MessageId'], position)
+            groups.setdefault(key, []).append((position, data_entry))
+
+        sorted_groups = []
+        for group in groups.values():
+            group.sort(key=lambda item: (int(item[1].get('Attributes', {}).get('SentTimestamp', 0)), item[0]))
+            sorted_groups.append([data_entry for position, data_entry in group])
+
+        duplicates = len(data_entries) - len(sorted_groups)
+        if duplicates:
+            self.duplicate_count += duplicates
+            self.logger.info("Skipped {0} duplicate data entries".format(duplicates))
+        return sorted_groups
+
+    def store_records(self, data_entries, dead_letter_queue=None):
+        """
+        Writes messages delivered by an SQS event source to the database with the same logic as
+        store_data_entries. The event source mapping deletes the messages that are not reported as failed,
+        so the written ones are only collected instead of being acknowledged.
+
+        :param data_entries: messages in the receive_message format
+        :param dead_letter_queue: SQS queue name for messages that cannot be written, defaults to DEAD_LETTER_QUEUE
+        :return: returns the messages that could not be written
+        """
+        written = AcknowledgementStage(self.sqs_client, None, auto_flush=False)
+        with db_connections.connection() as db_conn:
+            self.write_data_entries(db_conn, data_entries, written,
+                                    dead_letter_queue or os.environ.get('DEAD_LETTER_QUEUE'))
+
+        written_message_ids = set(data_entry['MessageId'] for data_entry in written.pending)
+        self.handled_count += len(data_entries)
+        self.logger.info("Handled {0} data entries".format(len(data_entries)))
+        return [data_entry for data_entry in data_entries if data_entry['MessageId'] not in written_message_ids]
+
+    def write_with_savepoints(self, db_cur, entries):
+        """
+        Writes entries of one form inside a savepoint. If the write fails the savepoint is rolled back and
+        the entries are bisected until the offending ones are found, so that the rest can still be committed.
+
+        :param db_cur: database cursor
+        :param entries: list of tuples of a group of duplicate messages and the parsed body to write
+        :return: list of tuples of a failed group and the error it failed with
+        """
+        db_cur.execute('SAVEPOINT batch_write;')
+        try:
+            self.write_batch_to_db(db_cur, [body for group, body in entries])
+            db_cur.execute('RELEASE SAVEPOINT batch_write;')
+            return []
+        except psycopg2.Error as e:
+            if not is_data_error(e):
+                raise
+            db_cur.execute('ROLLBACK TO SAVEPOINT batch_write;')
+            db_cur.execute('RELEASE SAVEPOINT batch_write;')
+            if len(entries) == 1:
+                return [(entries[0][0], e)]
+            middle = len(entries) // 2
+            return self.write_with_savepoints(db_cur, entries[:middle]) + \
+                self.write_with_savepoints(db_cur, entries[middle:])
+
+    @staticmethod
+    def is_systemic_failure(entries, failures):
+        """
+        Checks whether every entry of a batch failed with the same error. That points at the database, its
+        schema or the code rather than at the messages, which must then not be dead lettered. A missing
+        form table is never systemic, so its messages are dead lettered whatever the batch size.
+
+        :param entries: entries that were written
+        :param failures: list of tuples of a failed group and the error it failed with
+        """
+        if len(entries) < 2 or len(failures) < len(entries):
+            return False
+        if any(is_missing_table(error) for group, error in failures):
             return False
+        return len(set((type(error), str(error).strip()) for group, error in failures)) == 1
 
-        while len(data_entries) < self.max_number_of_messages:
-            new_entries = self.fetch_data_from_queue(nest_outgoing_queue)
+    def send_to_dead_letter_queue(self, failures, dead_letter_queue, acknowledgements):
+        """
+        Moves messages that could not be written to the dead letter queue with the reason attached as the
+        ErrorReason message attribute. Messages are acknowledged once they reached the dead letter queue,
+        without a dead letter queue they are left for the SQS redrive policy.
 
-            if len(new_entries) == 0:
-                break
+        :param failures: list of tuples of a failed group of duplicate messages and the error it failed with
+        :param dead_letter_queue: SQS queue name, or None
+        :param acknowledgements: AcknowledgementStage for the queue the messages were received from
+        """
+        failures = [(group, str(error).strip()) for group, error in failures]
+        for group, reason in failures:
+            self.logger.error("Failed to write message {0}: {1}".format(group[-1]['MessageId'], reason))
+        if not failures or not dead_letter_queue:
+            return
+
+        queue_url = self.sqs_client.create_queue(QueueName=dead_letter_queue)['QueueUrl']
+        for i in range(0, len(failures), SQS_MAX_BATCH_SIZE):
+            batch = failures[i:i + SQS_MAX_BATCH_SIZE]
+            response = self.sqs_client.send_message_batch(
+                QueueUrl=queue_url,
+                Entries=[
+                    {
+                        'Id': str(j),
+                        'MessageBody': group[-1]['Body'],
+                        'MessageAttributes': {
+                            'ErrorReason': {'DataType': 'String', 'StringValue': reason[:1024] or 'Unknown error'}
+                        }
+                    }
+                    for j, (group, reason) in enumerate(batch)
+                ]
+            )
+            for success in response.get('Successful', []):
+                group = batch[int(success['Id'])][0]
+                self.dead_letter_count += len(group)
+                for data_entry in group:
+                    acknowledgements.add(data_entry)
+
+    def write_data_entries(self, db_conn, data_entries, acknowledgements, dead_letter_queue=None):
+        """
+        Writes received messages to the database and hands the committed ones to the acknowledgement stage.
+        Messages that cannot be written because of their content are isolated and moved to the dead letter
+        queue. Any other database error, or the whole batch failing with the same error, is raised instead
+        and no message is acknowledged.
+
+        :param db_conn: psycopg2 connection
+        :param data_entries: messages received from SQS
+        :param acknowledgements: AcknowledgementStage for the queue the messages were received from
+        :param dead_letter_queue: SQS queue name for messages that cannot be written
+        """
+        failures = []
+        entries = []
+        for group in self.group_duplicates(data_entries):
+            try:
+                body = json.loads(group[-1]['Body'])
+                form_schemas.validate_form_id(body['formId'])
+            except (ValueError, KeyError, TypeError) as e:
+                failures.append((group, ValueError('Malformed message body: {0}'.format(e))))
+                continue
+            entries.append((group, body))
+
+        write_failures = []
+
+        with db_conn.cursor() as db_cur:
+            if self.bulk_write:
+                entries_by_form = {}
+                for group, body in entries:
+                    entries_by_form.setdefault(body['formId'], []).append((group, body))
+
+                # One transaction for the whole batch
+                try:
+                    for form_id, form_entries in entries_by_form.items():
+                        # Table creation failures are never caused by the messages
+                        self.prepare_form_table(db_cur, form_id)
+                        write_failures += self.write_with_savepoints(db_cur, form_entries)
+                    if self.is_systemic_failure(entries, write_failures):
+                        raise write_failures[0][1]
+                    self.commit(db_conn)
+                except Exception:
+                    self.rollback(db_conn)
+                    raise
+                failed_message_ids = set(group[-1]['MessageId'] for group, error in write_failures)
+                for group, body in entries:
+                    if group[-1]['MessageId'] not in failed_message_ids:
+                        for data_entry in group:
+                            acknowledgements.add(data_entry)
             else:
-                data_entries = data_entries + new_entries
+                for group, body in entries:
+                    try:
+                        self.prepare_form_table(db_cur, body['formId'])
+                    except Exception:
+                        self.rollback(db_conn)
+                        raise
+                    try:
+                        self.write_to_db(db_cur, body)
+                        self.commit(db_conn)
+                    except psycopg2.Error as e:
+                        self.rollback(db_conn)
+                        if not is_data_error(e):
+                            raise
+                        write_failures.append((group, e))
+                        continue
+                    for data_entry in group:
+                        acknowledgements.add(data_entry)
+                if self.is_systemic_failure(entries, write_failures):
+                    raise write_failures[0][1]
+
+        self.send_to_dead_letter_queue(failures + write_failures, dead_letter_queue, acknowledgements)
+
+    def receive_batch(self, queue, queue_url=None):
+        """
+        Receives up to max_number_of_messages messages from the queue. With RECEIVE_WORKERS greater than 1
+        several pollers receive at the same time and merge their messages into one bounded buffer.
+
+        :param queue: SQS queue name
+        :param queue_url: URL of the queue if it is already resolved
+        :return: list of received messages
+        """
+        # Resolve the URL once instead of in every poll
+        queue_url = queue_url or self.get_queue_url(queue)
+        data_entries = []
+        lock = threading.Lock()
+        reserved = [0]
+
+        def poll():
+            while True:
+                # Reserve room in the buffer so that the pollers never receive more than one batch
+                with lock:
+                    room = self.max_number_of_messages - len(data_entries) - reserved[0]
+                    if room <= 0:
+                        return
+                    requested = min(room, SQS_MAX_BATCH_SIZE)
+                    reserved[0] += requested
+                try:
+                    new_entries = self.fetch_data_from_queue(queue, requested, queue_url)
+                finally:
+                    with lock:
+                        reserved[0] -= requested
+                with lock:
+                    data_entries.extend(new_entries)
+                if len(new_entries) == 0:
+                    return
+
+        workers = max(1, min(self.receive_workers, -(-self.max_number_of_messages // SQS_MAX_BATCH_SIZE)))
+        if workers == 1:
+            poll()
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for future in [executor.submit(poll) for _ in range(workers)]:
+                    future.result()
+        return data_entries
+
+    def store_data_entries(self, queue=None, dead_letter_queue=None):
+        """
+        Main function to call functions
+
+        :param queue: SQS queue name, defaults to PERSISTENT_DATABASE_WRITER_QUEUE
+        :param dead_letter_queue: SQS queue name for messages that cannot be written, defaults to DEAD_LETTER_QUEUE
+        :return: binary value whether the Lambda function should be launched again
+        """
+
+        nest_outgoing_queue = queue or os.environ['PERSISTENT_DATABASE_WRITER_QUEUE']
+        self.logger.info("Fetching data from queue {0}".format(nest_outgoing_queue))
 
-        if len(data_entries) == self.max_number_of_messages:
+        self.call_again = False
+        queue_url = self.get_queue_url(nest_outgoing_queue)
+        data_entries = self.receive_batch(nest_outgoing_queue, queue_url)
+
+        if len(data_entries) == 0:
+            return False
+
+        # A full batch means the queue may still hold data
+        if len(data_entries) >= self.max_number_of_messages:
             self.call_again = True
 
-        for data_entry in data_entries:
-            self.write_to_db(db_cur, json.loads(data_entry['Body']))
-            db_conn.commit()
-            self.acknowledge_messages(nest_outgoing_queue, data_entry)
+        # Messages are acknowledged only once their DB commit succeeded
+        acknowledgements = AcknowledgementStage(self.sqs_client, queue_url)
+        try:
+            with db_connections.connection() as db_conn:
+                self.write_data_entries(db_conn, data_entries, acknowledgements,
+                                        dead_letter_queue or os.environ.get('DEAD_LETTER_QUEUE'))
+        finally:
+            unacknowledged = acknowledgements.flush()
+        if unacknowledged:
+            self.logger.warning("Failed to acknowledge {0} data entries".format(len(unacknowledged)))
 
+        self.handled_count += len(data_entries)
         self.logger.info("Handled {0} data entries".format(len(data_entries)))
 
-        # Close db cursor
-        if db_cur:
-            db_cur.close()
+        return self.call_again
 
-        # Close db connection
-        if db_conn:
-            db_conn.close()
+    def is_out_of_time(self, context):
+        """
+        Checks whether the Lambda invocation is about to reach its timeout
 
-        return self.call_again
+        :param context: Lambda context, or None when running outside Lambda
+        """
+        if context is None:
+            return False
+        return context.get_remaining_time_in_millis() < self.time_margin_ms
+
+    def reset_counters(self):
+        """
+        Resets the counters that are reported in the summary of a drain
+        """
+        self.handled_count = 0
+        self.duplicate_count = 0
+        self.skipped_write_count = 0
+        self.dead_letter_count = 0
+
+    def log_summary(self, queue):
+        """
+        Logs the counters of a drain as one line, so they are visible with the default LOGGING_LEVEL
+
+        :param queue: SQS queue name the data entries were read from
+        """
+        summary_logger.warning(
+            "Drain summary for {0}: handled={1} duplicates={2} skipped_writes={3} dead_lettered={4}".format(
+                queue, self.handled_count, self.duplicate_count, self.skipped_write_count, self.dead_letter_count))
+
+    def drain_queue(self, queue, context=None, dead_letter_queue=None):
+        """
+        Writes batches from the queue until it is empty or the Lambda invocation runs out of time,
+        then logs a summary of the drain
+
+        :param queue: SQS queue name
+        :param context: Lambda context used to read the remaining time
+        :param dead_letter_queue: SQS queue name for messages that cannot be written
+        :return: True if the queue may still hold data
+        """
+        self.reset_counters()
+        try:
+            if self.pipeline_depth > 0:
+                return self.drain_queue_pipelined(queue, context, dead_letter_queue)
+            while self.store_data_entries(queue, dead_letter_queue):
+                if self.is_out_of_time(context):
+                    return True
+            return False
+        finally:
+            self.log_summary(queue)
+
+    def drain_queue_pipelined(self, queue, context=None, dead_letter_queue=None):
+        """
+        Drains the queue with receiving, writing and acknowledging running as overlapping stages, so that
+        batch k+1 is received while batch k is written and batch k-1 is acknowledged. The stages are
+        connected by buffers holding at most pipeline_depth batches, and a batch only reaches the
+        acknowledging stage once its transaction is committed.
+
+        :param queue: SQS queue name
+        :param context: Lambda context used to read the remaining time
+        :param dead_letter_queue: SQS queue name for messages that cannot be written
+        :return: True if the queue may still hold data
+        """
+        queue_url = self.get_queue_url(queue)
+        dead_letter_queue = dead_letter_queue or os.environ.get('DEAD_LETTER_QUEUE')
+        received = Queue(maxsize=self.pipeline_depth)
+        committed = Queue(maxsize=self.pipeline_depth)
+        stopped = threading.Event()
+        work_remaining = [False]
+
+        def receive():
+            try:
+                while not stopped.is_set():
+                    if self.is_out_of_time(context):
+                        work_remaining[0] = True
+                        break
+                    data_entries = self.receive_batch(queue, queue_url)
+                    # Received messages that are dropped here are redelivered after their visibility timeout
+                    while data_entries and not stopped.is_set():
+                        try:
+                            received.put(data_entries, timeout=0.1)
+                            break
+                        except Full:
+                            pass
+                    # A full batch means the queue may still hold data
+                    if len(data_entries) < self.max_number_of_messages:
+                        break
+            except BaseException:
+                stopped.set()
+                raise
+            finally:
+                received.put(None)
+
+        def acknowledge():
+            while True:
+                acknowledgements = committed.get()
+                if acknowledgements is None:
+                    return
+                try:
+                    unacknowledged = acknowledgements.flush()
+                except Exception:
+                    self.logger.exception("Failed to acknowledge data entries")
+                    continue
+                if unacknowledged:
+                    self.logger.warning("Failed to acknowledge {0} data entries".format(len(unacknowledged)))
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            receiver = executor.submit(receive)
+            acknowledger = executor.submit(acknowledge)
+            try:
+                while True:
+                    try:
+                        data_entries = received.get(timeout=0.1)
+                    except Empty:
+                        if stopped.is_set():
+                            break
+                        continue
+                    if data_entries is None:
+                        break
+                    acknowledgements = AcknowledgementStage(self.sqs_client, queue_url, auto_flush=False)
+                    try:
+                        with db_connections.connection() as db_conn:
+                            self.write_data_entries(db_conn, data_entries, acknowledgements, dead_letter_queue)
+                    finally:
+                        # Only messages whose transaction was committed are in the stage
+                        committed.put(acknowledgements)
+                    self.handled_count += len(data_entries)
+                    self.logger.info("Handled {0} data entries".format(len(data_entries)))
+            except BaseException:
+                stopped.set()
+                raise
+            finally:
+                # Drain the receiving stage so that it cannot block on a full buffer
+                while not receiver.done():
+                    try:
+                        received.get(timeout=0.1)
+                    except Empty:
+                        pass
+                committed.put(None)
+            receiver.result()
+            acknowledger.result()
+
+        self.call_again = work_remaining[0]
+        return work_remaining[0]
+
+    def get_outgoing_topic(self):
+        """
+        Get the topic that triggers the persistent database writer
+
+        :return: Topic ARN
+        """
+        topic = self.sns_client.create_topic(
+            Name='nest-outgoing-topic-' + os.environ['ORG'].lower()
+        )
+        return topic['TopicArn']
+
+
+# Known form tables are cached across warm Lambda invocations
+form_schemas = FormSchemaManager()
+
+# Database connections are kept open across warm Lambda invocations
+db_connections = DatabaseConnectionHolder(
+    connect=PersistentDatabaseWriter.connect_to_db,
+    pool_size=int(os.environ.get('DB_POOL_SIZE', 1))
+)
+
+
+def sqs_records_to_data_entries(event):
+    """
+    Converts the records of an SQS event source batch into the format returned by receive_message
+
+    :param event: Lambda event with SQS records
+    :return: list of messages
+    """
+    return [
+        {
+            'MessageId': record['messageId'],
+            'ReceiptHandle': record['receiptHandle'],
+            'Body': record['body'],
+            'Attributes': record.get('attributes', {})
+        }
+        for record in event.get('Records', [])
+    ]
+
+
+def get_notifications(event):
+    """
+    Reads the notifications from every SNS record in the event and merges the ones that point to the same queue
+
+    :param event: Lambda event with SNS records
+    :return: list of notification messages, one per queue
+    """
+    default_queue = os.environ['PERSISTENT_DATABASE_WRITER_QUEUE']
+    notifications = {}
+    for record in event.get('Records', []):
+        message = json.loads(record['Sns']['Message'])
+        message.setdefault('queue', default_queue)
+        notifications.setdefault(message['queue'], message)
+    if not notifications:
+        notifications[default_queue] = {'queue': default_queue}
+    return list(notifications.values())
 
 
 def lambda_handler(event, context):
@@ -175,9 +1091,44 @@ def lambda_handler(event, context):
     """
 
     writer = PersistentDatabaseWriter()
-    call_again = writer.store_data_entries()
+    records = event.get('Records', [])
+    topic = records[0]['Sns'].get('TopicArn') if records else None
+    for message in get_notifications(event):
+        call_again = writer.is_out_of_time(context) or \
+            writer.drain_queue(message['queue'], context, message.get('dead_letter_queue'))
 
-#    if call_again:
-#        writer.notify_outgoing_topic(topic=topic, message=message)
+        # Hand the remaining backlog over to a new invocation
+        if call_again:
+            writer.notify_outgoing_topic(topic=topic or writer.get_outgoing_topic(), message=message)
 
     return 'Lambda run for ' + os.environ['ORG']
+
+
+def sqs_lambda_handler(event, context):
+    """
+    Writes messages delivered directly by an SQS event source mapping to the persistent database.
+    Requires ReportBatchItemFailures on the event source mapping so that only failed messages are redelivered.
+    :param event: SQS event source batch
+    :param context:
+    :return: partial batch response listing the messages that could not be written
+    """
+    writer = PersistentDatabaseWriter()
+    records = event.get('Records', [])
+    queue = records[0].get('eventSourceARN', '').split(':')[-1] if records else None
+    try:
+        failed_entries = writer.store_records(sqs_records_to_data_entries(event))
+    finally:
+        writer.log_summary(queue)
+
+    return {'batchItemFailures': [{'itemIdentifier': data_entry['MessageId']} for data_entry in failed_entries]}
+
+
+if __name__ == '__main__':
+    # Long-lived worker outside Lambda, keeps draining the queue over the same database connection
+    worker = PersistentDatabaseWriter()
+    while True:
+        try:
+            worker.drain_queue(os.environ['PERSISTENT_DATABASE_WRITER_QUEUE'])
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            worker.logger.exception("Lost the database connection, retrying")
+            time.sleep(int(os.environ.get('WORKER_RETRY_INTERVAL', 5)))
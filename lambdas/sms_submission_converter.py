@@ -1,66 +1,316 @@
 import collections
+import io
 import json
 import logging
 import os
+import threading
 import time
+import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import escape
 
 import boto3
+import botocore.config
+import botocore.exceptions
 import requests
+import requests.adapters
+import urllib3.util.retry
 import xmltodict
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+# boto3 clients are created lazily and reused across warm Lambda invocations
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(service_name):
+    """
+    Returns a shared boto3 client for the given service, creating it on first use.
+    Region, connection pool size and retry behaviour are read from the environment.
+
+    :param service_name: AWS service name, e.g. 'sqs'
+    :return: boto3 client
+    """
+    client = clients.get(service_name)
+    if client is None:
+        with clients_lock:
+            client = clients.get(service_name)
+            if client is None:
+                config = botocore.config.Config(
+                    max_pool_connections=int(os.environ.get('BOTO_MAX_POOL_CONNECTIONS', 10)),
+                    retries={
+                        'mode': os.environ.get('BOTO_RETRY_MODE', 'standard'),
+                        'max_attempts': int(os.environ.get('BOTO_MAX_ATTEMPTS', 3))
+                    }
+                )
+                region_name = os.environ.get('AWS_REGION', os.environ.get('AWS_DEFAULT_REGION'))
+                client = boto3.client(service_name, region_name=region_name, config=config)
+                clients[service_name] = client
+    return client
+
+
+# HTTP sessions for Aggregate, with and without retries, kept alive across warm Lambda invocations
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+
+
+def get_http_max_retries():
+    return int(os.environ.get('HTTP_MAX_RETRIES', 3))
+
+
+def get_http_session(retry=True):
+    """
+    Returns a shared HTTP session for Aggregate, creating it on first use. Pool size and the retry
+    policy are read from the environment. Connection errors are retried with backoff, server errors
+    only for GET requests. Read timeouts are never retried, so that a hung Aggregate is only waited
+    for once.
+
+    :param retry: whether the session retries failed requests
+    :return: requests session
+    """
+    session = http_sessions.get(retry)
+    if session is None:
+        with http_sessions_lock:
+            session = http_sessions.get(retry)
+            if session is None:
+                max_retries = get_http_max_retries() if retry else 0
+                retries = urllib3.util.retry.Retry(
+                    total=max_retries,
+                    connect=max_retries,
+                    read=0,
+                    status=max_retries,
+                    backoff_factor=float(os.environ.get('HTTP_BACKOFF_FACTOR', 0.3)),
+                    status_forcelist=(500, 502, 503, 504),
+                    allowed_methods=frozenset(['GET']),
+                    raise_on_status=False
+                )
+                pool_size = int(os.environ.get('HTTP_POOL_SIZE', 10))
+                adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                                        max_retries=retries)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                http_sessions[retry] = session
+    return session
+
+
+def get_http_timeout(deadline=None, retry=True, read_timeout=None, method='GET'):
+    """
+    Returns the connect and read timeouts in seconds for requests to Aggregate. With a deadline the time
+    that is left is split between the attempts of the request, so that retries cannot outlast it. Server
+    errors are only retried for GET requests, other requests retry the connection and read the response once.
+
+    :param deadline: time.monotonic() value by which the request must be finished, or None
+    :param retry: whether the request is sent with retries
+    :param read_timeout: read timeout to use instead of HTTP_READ_TIMEOUT
+    :param method: HTTP method of the request
+    :return: tuple of the connect and read timeouts
+    :raises requests.Timeout: if the deadline has passed
+    """
+    connect_timeout = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+    if read_timeout is None:
+        read_timeout = float(os.environ.get('HTTP_READ_TIMEOUT', 10))
+    if deadline is None:
+        return connect_timeout, read_timeout
+
+    max_retries = get_http_max_retries() if retry else 0
+    backoff_factor = float(os.environ.get('HTTP_BACKOFF_FACTOR', 0.3))
+    remaining = deadline - time.monotonic() - sum(backoff_factor * 2 ** i for i in range(max_retries))
+    if remaining <= 0:
+        raise requests.Timeout("No time left for the request to Aggregate")
+    attempts = max_retries + 1
+    connect_timeout = min(connect_timeout, remaining / attempts / 2)
+    if method == 'GET':
+        return connect_timeout, min(read_timeout, remaining / attempts - connect_timeout)
+    return connect_timeout, min(read_timeout, remaining - attempts * connect_timeout)
+
+
+# Namespaces of the XForms elements and attributes read from form definitions
+XFORMS_NAMESPACE = '{http://www.w3.org/2002/xforms}'
+ODK_TAG_ATTRIBUTE = '{http://www.opendatakit.org/xforms}tag'
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+class FormDefinitionCache:
+    """
+    Cache of form definitions from Aggregate and the values derived from them. Lives at module level
+    so that it survives warm Lambda invocations. An entry is fresh for ttl seconds, after that it is
+    revalidated with a conditional request and may still be served for up to max_stale seconds if
+    Aggregate cannot be reached.
+    """
+    def __init__(self, ttl, max_stale):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.entries = {}
+
+    def get(self, key):
+        """
+        Returns the cached entry, fresh or not, or None if the key is not cached
+        :param key: tuple of the Aggregate URL and the form ID
+        """
+        return self.entries.get(key)
+
+    def is_fresh(self, entry):
+        return time.monotonic() < entry['validated_at'] + self.ttl
+
+    def is_usable_stale(self, entry):
+        return time.monotonic() < entry['validated_at'] + self.ttl + self.max_stale
+
+    def set(self, key, form_xml, etag=None, last_modified=None):
+        """
+        Stores a freshly downloaded form definition, dropping the values derived from the previous one
+        :param key: tuple of the Aggregate URL and the form ID
+        :param form_xml: form definition XML as bytes
+        :param etag: ETag header of the response
+        :param last_modified: Last-Modified header of the response
+        :return: the new entry
+        """
+        entry = {
+            'xml': form_xml,
+            'etag': etag,
+            'last_modified': last_modified,
+            'validated_at': time.monotonic(),
+            'derived': {}
+        }
+        self.entries[key] = entry
+        return entry
+
+    def revalidated(self, key):
+        """
+        Marks an entry as fresh again after Aggregate reported that the form did not change
+        :param key: tuple of the Aggregate URL and the form ID
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry['validated_at'] = time.monotonic()
+        return entry
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class FormCodec:
+    """
+    Encoder for the submissions of one form, compiled once from the map of short to long field names.
+    Every short tag is resolved to its group and to the XML tags of its field in advance, so that encoding
+    a submission only escapes the values and joins the fragments. The output is identical to
+    SmsSubmissionConverter._to_xml_string.
+    """
+    XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>\n'
+
+    def __init__(self, form_id, ids_map):
+        self.header = f'{self.XML_DECLARATION}<{form_id} id="{form_id}">'
+        self.footer = f'</{form_id}>'
+        self.fields = {}
+        self.group_tags = {}
+        for short_id, ids in ids_map.items():
+            group_path = ids.get('groupPath', [ids['groupName']] if ids['groupName'] else [])
+            self.fields[short_id] = (group_path, ids['fieldName'], f"<{ids['fieldName']}>", f"</{ids['fieldName']}>")
+            for group_name in group_path:
+                self.group_tags[group_name] = (f"<{group_name}>", f"</{group_name}>")
+
+    def encode(self, prepared_payload):
+        """
+        Encodes a submission as XML
+        :param prepared_payload: dictionary with the form ID and the submitted values by short tag
+        :return: submission XML
+        """
+        # Fields keep the position of their first value, groups the position of their first field
+        elements = {}
+        for name, value in prepared_payload['data'].items():
+            if name == 'form_id':
+                continue
+            group_path, field_name, open_tag, close_tag = self.fields[name]
+            group = elements
+            for group_name in group_path:
+                group = group.setdefault(group_name, {})
+            group[field_name] = open_tag + escape(str(value)) + close_tag
+
+        parts = [self.header]
+        self._append_elements(elements, parts)
+        parts.append(self.footer)
+        return ''.join(parts)
+
+    def _append_elements(self, elements, parts):
+        for name, element in elements.items():
+            if isinstance(element, dict):
+                open_tag, close_tag = self.group_tags[name]
+                parts.append(open_tag)
+                self._append_elements(element, parts)
+                parts.append(close_tag)
+            else:
+                parts.append(element)
+
+
+form_definitions = FormDefinitionCache(ttl=int(os.environ.get('FORM_CACHE_TTL', 300)),
+                                       max_stale=int(os.environ.get('FORM_CACHE_MAX_STALE', 86400)))
+
+
 class SmsSubmissionConverter:
     def __init__(self):
         self.logger = logging.getLogger()
         self.logger.setLevel(logging.INFO)
+        self.received_items = {}
+        # time.monotonic() value by which requests to Aggregate must be finished
+        self.deadline = None
 
     def store_multi_sms_payload(self, payload):
+        """
+        Records a part of a multi part SMS on the SmsReceived item of its ref with a single conditional
+        update. The part is stored as attribute part_N and the received count is only incremented for a
+        part that was not seen before, so a redelivered part never completes a message twice. The item
+        expires SMS_PARTS_TTL seconds after its last part through the expiresAt TTL attribute.
+
+        :param payload: API Gateway event with the SMS
+        :return: ref, total and part of the SMS and whether all parts have been received
+        """
         body = json.loads(payload['body'])
         ref = body['concat-ref']
         total = body['concat-total']
         part = body['concat-part']
         text = body['text']
-        client = boto3.client('dynamodb')
-        client.put_item(
-            Item={
-                'ref': {
-                    'S': ref,
-                },
-                'total': {
-                    'N': total,
+        client = get_client('dynamodb')
+        try:
+            r = client.update_item(
+                TableName='SmsReceived',
+                Key={
+                    'ref': {
+                        'S': ref
+                    }
                 },
-                'part': {
-                    'S': part,
+                ExpressionAttributeNames={
+                    '#count': 'count',
+                    '#part': f'part_{int(part)}',
+                    '#total': 'total',
+                    '#receivedTime': 'receivedTime',
+                    '#expiresAt': 'expiresAt'
                 },
-                'text': {
-                    'S': text,
+                UpdateExpression='SET #part = :text, #total = :total, #receivedTime = :received_time, '
+                                 '#expiresAt = :expires_at ADD #count :inc',
+                ConditionExpression='attribute_not_exists(#part)',
+                ExpressionAttributeValues={
+                    ':text': {'S': text},
+                    ':total': {'N': str(total)},
+                    ':received_time': {'S': str(time.strftime("%Y-%m-%d %H:%M %Z"))},
+                    ':expires_at': {'N': str(int(time.time()) + int(os.environ.get('SMS_PARTS_TTL', 604800)))},
+                    ':inc': {'N': '1'}
                 },
-                'receivedTime': {
-                    'S': str(time.strftime("%Y-%m-%d %H:%M %Z"))
-                }
-            },
-            ReturnConsumedCapacity='TOTAL',
-            TableName='SmsParts',
-        )
-        r = client.update_item(
-            TableName='SmsReceived',
-            Key={
-                'ref': {
-                    'S': ref
-                }
-            },
-            ExpressionAttributeNames={
-                '#count': "count"
-            },
-            UpdateExpression='ADD #count :inc',
-            ExpressionAttributeValues={
-                ':inc': {'N': '1'}
-            },
-            ReturnValues="UPDATED_NEW"
-        )
+                ReturnValues="ALL_NEW"
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                raise
+            logger.info(f"Part {part} of {ref} was already received")
+            return ref, total, part, False
+        self.received_items[ref] = r['Attributes']
         received_count = int(r['Attributes']['count']['N'])
         is_complete = received_count == int(total)
         logger.info(f"Counter: received {received_count}, total {total}, is_complete {is_complete}")
@@ -95,15 +345,108 @@ class SmsSubmissionConverter:
         return {'form_id': form_id,
                 'data': form_content}
 
-    def get_form_definition(self, aggregate_url, form_id):
+    def get_form_entry(self, aggregate_url, form_id):
+        """
+        Returns the cache entry with the form definition XML from Aggregate. Entries are revalidated with
+        If-None-Match / If-Modified-Since once their TTL has passed. If the revalidation fails or times out
+        the stale entry is served instead.
+
+        :param aggregate_url: base URL of Aggregate
+        :param form_id: form ID
+        :return: FormDefinitionCache entry
+        """
+        key = (aggregate_url, form_id)
+        entry = form_definitions.get(key)
+        if entry is not None and form_definitions.is_fresh(entry):
+            return entry
+
         form_url = "{}/formXml".format(aggregate_url)
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            if entry is None:
+                session = get_http_session()
+                timeout = get_http_timeout(self.deadline)
+            else:
+                # Ask Aggregate only once and not for long when a stale definition can be served
+                session = get_http_session(retry=False)
+                timeout = get_http_timeout(self.deadline, retry=False,
+                                           read_timeout=float(os.environ.get('FORM_REVALIDATE_TIMEOUT', 2)))
+            form_response = session.get(form_url, params={'formId': form_id}, headers=headers, timeout=timeout)
+            if form_response.status_code == 304 and entry is not None:
+                return form_definitions.revalidated(key)
+            form_response.raise_for_status()
+        except requests.RequestException:
+            if entry is not None and form_definitions.is_usable_stale(entry):
+                logger.warning(f"Failed to revalidate form {form_id}, serving the cached definition")
+                return entry
+            raise
+
+        return form_definitions.set(key, form_response.content,
+                                    etag=form_response.headers.get('ETag'),
+                                    last_modified=form_response.headers.get('Last-Modified'))
+
+    def get_derived(self, aggregate_url, form_id, name, build):
+        """
+        Returns a value derived from the form definition XML, built once per cached form definition
+
+        :param aggregate_url: base URL of Aggregate
+        :param form_id: form ID
+        :param name: name of the derived value
+        :param build: function that builds the value from the form definition XML
+        """
+        return self.derive(self.get_form_entry(aggregate_url, form_id), name, build)
+
+    @staticmethod
+    def derive(entry, name, build):
+        """
+        Returns a value derived from the form definition XML of a cache entry, building it on first use
+
+        :param entry: FormDefinitionCache entry
+        :param name: name of the derived value
+        :param build: function that builds the value from the form definition XML
+        """
+        if name not in entry['derived']:
+            entry['derived'][name] = build(entry['xml'])
+        return entry['derived'][name]
+
+    def get_form_definition(self, aggregate_url, form_id):
+        """
+        Returns the form definition from Aggregate parsed with xmltodict
 
-        form_response = requests.get(form_url, params={'formId': form_id})
+        :param aggregate_url: base URL of Aggregate
+        :param form_id: form ID
+        :return: form definition
+        """
+        return self.get_derived(aggregate_url, form_id, 'definition', xmltodict.parse)
 
-        form_xml = form_response.text
-        form_definition = xmltodict.parse(form_xml)
+    def get_ids_map(self, aggregate_url, form_id):
+        """
+        Returns the map of short to long field names of a form
 
-        return form_definition
+        :param aggregate_url: base URL of Aggregate
+        :param form_id: form ID
+        :return: dictionary of short field name to field and group name
+        """
+        return self.get_derived(aggregate_url, form_id, 'ids_map', self._extract_ids_map)
+
+    def get_form_codec(self, aggregate_url, form_id):
+        """
+        Returns the compiled submission encoder of a form
+
+        :param aggregate_url: base URL of Aggregate
+        :param form_id: form ID
+        :return: FormCodec
+        """
+        # The codec and its ids map are derived from the same entry, so Aggregate is asked at most once
+        entry = self.get_form_entry(aggregate_url, form_id)
+        return self.derive(entry, 'codec',
+                           lambda form_xml: FormCodec(form_id, self.derive(entry, 'ids_map', self._extract_ids_map)))
 
     def payload_json_to_xml(self, form_definition, prepared_payload):
         form_id = prepared_payload['form_id']
@@ -165,18 +508,79 @@ class SmsSubmissionConverter:
         return ids_map
 
 
+    def _extract_ids_map(self, form_xml):
+        """
+        Builds the map of short to long field names by streaming through the form definition. Only the
+        primary instance of the model is read and parsing stops at its end. Fields tagged with odk:tag
+        are found at any depth of nested and repeat groups; of repeated fields the first one is used.
+
+        :param form_xml: form definition XML as bytes
+        :return: dictionary of short field name to field name, innermost group name and path of groups
+        """
+        ids_map = dict()
+        path = []
+        instance_depth = None
+        for event, element in ElementTree.iterparse(io.BytesIO(form_xml), events=('start', 'end')):
+            if event == 'start':
+                path.append(local_name(element.tag))
+                if instance_depth is None:
+                    if element.tag == XFORMS_NAMESPACE + 'instance' and path[-3:-1] == ['head', 'model']:
+                        instance_depth = len(path)
+                    continue
+                # Groups of a field are its ancestors below the root element of the instance
+                group_path = path[instance_depth + 1:-1]
+                short_id = element.get(ODK_TAG_ATTRIBUTE)
+                if short_id and len(path) > instance_depth + 1 and short_id not in ids_map:
+                    ids_map[short_id] = {
+                        "fieldName": path[-1],
+                        "groupName": group_path[-1] if group_path else '',
+                        "groupPath": group_path
+                    }
+            else:
+                path.pop()
+                element.clear()
+                if instance_depth is not None and len(path) < instance_depth:
+                    break
+        return ids_map
+
     def get_complete_multi_sms_payload(self, ref):
-        client = boto3.client('dynamodb')
-        response = client.query(TableName='SmsParts',
-                                ExpressionAttributeValues={':ref_value': {'S': str(ref)}},
-                                ExpressionAttributeNames={'#ref_alias': 'ref'},
-                                KeyConditionExpression='#ref_alias = :ref_value'
-                                )
-        return ''.join([part['text']['S'] for part in response['Items']])
+        """
+        Joins the parts of a multi part SMS in the order of their part numbers. Parts come from the item
+        returned when the last part was stored, or are read from SmsReceived if this converter did not
+        store it; parts stored in SmsParts by earlier versions are read with a paginated query.
+
+        :param ref: concat-ref of the SMS
+        :return: text of the complete SMS
+        """
+        item = self.received_items.get(ref)
+        if item is None:
+            response = get_client('dynamodb').get_item(TableName='SmsReceived',
+                                                       Key={'ref': {'S': str(ref)}},
+                                                       ConsistentRead=True)
+            item = response.get('Item', {})
+        parts = {
+            int(name[len('part_'):]): value['S']
+            for name, value in item.items() if name.startswith('part_')
+        }
+        if 'total' not in item or len(parts) < int(item['total']['N']):
+            client = get_client('dynamodb')
+            paginator = client.get_paginator('query')
+            for page in paginator.paginate(TableName='SmsParts',
+                                           ExpressionAttributeValues={':ref_value': {'S': str(ref)}},
+                                           ExpressionAttributeNames={'#ref_alias': 'ref'},
+                                           KeyConditionExpression='#ref_alias = :ref_value'):
+                for part in page['Items']:
+                    parts.setdefault(int(part['part']['S']), part['text']['S'])
+        return ''.join(text for number, text in sorted(parts.items()))
 
 
 def lambda_handler(event, context):
     translator = SmsSubmissionConverter()
+    # Fetching the form and submitting to Aggregate must fit in the invocation and the API Gateway timeout
+    time_budget = float(os.environ.get('HTTP_DEADLINE', 25))
+    if context is not None:
+        time_budget = min(time_budget, context.get_remaining_time_in_millis() / 1000 - 1)
+    translator.deadline = time.monotonic() + time_budget
     is_multi_sms = translator.is_multi_sms_payload(event)
     if is_multi_sms:
         logger.info("Multi part sms submission.")
@@ -196,11 +600,12 @@ def lambda_handler(event, context):
     payload = translator.format_payload(raw_payload)
     aggregate_url = os.environ.get('AGGREGATE_URL')
 
-    form_definition = translator.get_form_definition(aggregate_url, payload['form_id'])
-    submission_xml = translator.payload_json_to_xml(form_definition, payload)
+    codec = translator.get_form_codec(aggregate_url, payload['form_id'])
+    submission_xml = codec.encode(payload)
 
     files = {'xml_submission_file': ('form.xml', submission_xml, "text/xml")}
-    r = requests.post(aggregate_url + "/submission", files=files)
+    r = get_http_session().post(aggregate_url + "/submission", files=files,
+                                timeout=get_http_timeout(translator.deadline, method='POST'))
 
     logger.info(f'Send submission to aggregate with code {r.status_code}')
     return {
@@ -2,10 +2,13 @@
 Lambda Queue Consumer Test
 """
 
+import json
+import os
 import unittest
-from unittest.mock import MagicMock, call
+from unittest.mock import MagicMock, call, patch
 import datetime
 from dateutil.tz import tzutc
+import botocore
 
 import lambdas.nest_queue_consumer as nest_queue_consumer
 
@@ -21,6 +24,8 @@ class NestQueueConsumerTest(unittest.TestCase):
             'queue': 'nest-test-queue',
             'dead-letter-queue': 'nest-test-dead-letter-queue'
         }
+        nest_queue_consumer.resolution_cache.clear()
+        nest_queue_consumer.subscriber_registry.invalidate()
         self.consumer = nest_queue_consumer.NestQueueConsumer()
         self.consumer.sts_client.get_caller_identity = MagicMock(return_value={
             'Account': 'test-account'
@@ -32,35 +37,36 @@ class NestQueueConsumerTest(unittest.TestCase):
         self.consumer.sqs_client.get_queue_url = MagicMock(return_value={
             'QueueUrl': 'aws:nest-test-queue-url'
         })
-        self.consumer.sqs_client.send_message = MagicMock(return_value={
-            'MD5OfMessageBody': 'test-md5',
-            'MD5OfMessageAttributes': 'test-md5',
-            'MessageId': 'test-message-id',
-            'SequenceNumber': 'test-sequence-number'
+        self.consumer.sqs_client.send_message_batch = MagicMock(return_value={
+            'Successful': [],
+            'Failed': []
         })
-        self.consumer.sqs_client.receive_message = MagicMock(return_value={
-            'Messages': [
-                {
-                    'MessageId': 'test-message-id-1',
-                    'ReceiptHandle': 'test-receipt-handle-1',
-                    'MD5OfBody': 'test-md5-1',
-                    'Body': 'test-body-1',
-                    'Attributes': {
-                        'test-attribute': 'test-attribute-value'
-                    }
-                },
-                {
-                    'MessageId': 'test-message-id-2',
-                    'ReceiptHandle': 'test-receipt-handle-2',
-                    'MD5OfBody': 'test-md5-2',
-                    'Body': 'test-body-2',
-                    'Attributes': {
-                        'test-attribute': 'test-attribute-value'
-                    }
+        self.messages = [
+            {
+                'MessageId': 'test-message-id-1',
+                'ReceiptHandle': 'test-receipt-handle-1',
+                'MD5OfBody': 'test-md5-1',
+                'Body': 'test-body-1',
+                'Attributes': {
+                    'test-attribute': 'test-attribute-value'
                 }
-            ]
+            },
+            {
+                'MessageId': 'test-message-id-2',
+                'ReceiptHandle': 'test-receipt-handle-2',
+                'MD5OfBody': 'test-md5-2',
+                'Body': 'test-body-2',
+                'Attributes': {
+                    'test-attribute': 'test-attribute-value'
+                }
+            }
+        ]
+        # The incoming queue is empty after the first receive
+        self.consumer.sqs_client.receive_message = MagicMock(side_effect=[{'Messages': self.messages}, {}])
+        self.consumer.sqs_client.delete_message_batch = MagicMock(return_value={
+            'Successful': [],
+            'Failed': []
         })
-        self.consumer.sqs_client.delete_message = MagicMock(return_value=None)
 
         self.consumer.sns_client.create_topic = MagicMock(return_value={
             'TopicArn': 'arn:aws:sns:eu-west-1:test-account:nest-test-topic'
@@ -203,9 +209,9 @@ class NestQueueConsumerTest(unittest.TestCase):
         # Test creating queues for endpoint consumers to consume.
         # Lambda consumer forwards incoming data to these queues.
         self.assertTrue(self.consumer.sqs_client.create_queue.called)
+        # One queue per EC2 subscriber, the archivist and the test subscriber
         self.assertEqual(self.consumer.sqs_client.create_queue.call_count,
-                         (len(self.consumer.ec2_client.describe_instances.return_value['Reservations']) + 1) *
-                         len(self.consumer.sqs_client.receive_message.return_value['Messages']))
+                         len(self.consumer.ec2_client.describe_instances.return_value['Reservations']) + 2)
         create_queue_calls = [
             call(QueueName='nest-test-queue-development-demo-a57f82'),
             call(QueueName='nest-test-queue-master-demo-f914fa'),
@@ -216,44 +222,137 @@ class NestQueueConsumerTest(unittest.TestCase):
     def test_queue_url_generation(self):
         self.assertTrue(self.consumer.sqs_client.get_queue_url.called)
 
+    def test_queue_resolution_is_cached(self):
+        # Account ID and queue URLs are resolved once per warm container
+        self.assertEqual(self.consumer.sts_client.get_caller_identity.call_count, 1)
+        self.assertEqual(self.consumer.sqs_client.get_queue_url.call_count, 1)
+        create_queue_count = self.consumer.sqs_client.create_queue.call_count
+
+        self.consumer.sqs_client.receive_message = MagicMock(side_effect=[{'Messages': self.messages}, {}])
+        self.consumer.distribute_data(self.event)
+
+        self.assertEqual(self.consumer.sts_client.get_caller_identity.call_count, 1)
+        self.assertEqual(self.consumer.sqs_client.get_queue_url.call_count, 1)
+        self.assertEqual(self.consumer.sqs_client.create_queue.call_count, create_queue_count)
+
+    def test_queue_resolution_cache_expires(self):
+        cache = nest_queue_consumer.ResolutionCache(ttl=0)
+        cache.set('nest-test-queue', 'aws:nest-test-queue-url')
+        self.assertIsNone(cache.get('nest-test-queue'))
+
+    def test_missing_outgoing_queue_is_recreated(self):
+        missing_queue_error = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'AWS.SimpleQueueService.NonExistentQueue'}}, 'SendMessageBatch')
+        self.consumer.sqs_client.send_message_batch = MagicMock(side_effect=[
+            missing_queue_error, {'Successful': [{'Id': '0'}], 'Failed': []}
+        ])
+        create_queue_count = self.consumer.sqs_client.create_queue.call_count
+
+        failed = self.consumer.redirect_data_to_subscriber(
+            'persistent_database_writer', 'nest-test-queue', 'nest-test-dead-letter-queue', self.messages[:1])
+
+        self.assertEqual(failed, [])
+        self.assertEqual(self.consumer.sqs_client.create_queue.call_count, create_queue_count + 1)
+
+    def test_missing_incoming_queue_invalidates_cache(self):
+        missing_queue_error = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'AWS.SimpleQueueService.NonExistentQueue'}}, 'ReceiveMessage')
+        self.consumer.sqs_client.receive_message = MagicMock(side_effect=missing_queue_error)
+
+        with self.assertRaises(botocore.exceptions.ClientError):
+            list(self.consumer.get_incoming_data('nest-test-queue'))
+        self.assertIsNone(nest_queue_consumer.resolution_cache.get('nest-test-queue'))
+
+    def test_clients_are_shared_between_invocations(self):
+        # boto3 clients are reused by consumers created in the same warm container
+        consumer = nest_queue_consumer.NestQueueConsumer()
+        self.assertIs(consumer.sqs_client, self.consumer.sqs_client)
+        self.assertIs(nest_queue_consumer.get_client('sns'), self.consumer.sns_client)
+
     def test_incoming_queue_reading(self):
         # Test reading messages from incoming data queue
         self.assertTrue(self.consumer.sqs_client.receive_message.called)
 
     def test_message_acknowledging(self):
         # Test acknowledging and deleting messages from incoming queue once they are consumed
-        self.assertTrue(self.consumer.sqs_client.delete_message.called)
-        self.assertEqual(self.consumer.sqs_client.delete_message.call_count,
-                         len(self.consumer.sqs_client.receive_message.return_value['Messages']))
-        delete_message_calls = [
-            call(
-                QueueUrl='aws:nest-test-queue-url',
-                ReceiptHandle='test-receipt-handle-1'
-            ),
-            call(
-                QueueUrl='aws:nest-test-queue-url',
-                ReceiptHandle='test-receipt-handle-2'
-            )
-        ]
-        self.consumer.sqs_client.delete_message.assert_has_calls(delete_message_calls, any_order=True)
+        self.assertTrue(self.consumer.sqs_client.delete_message_batch.called)
+        self.assertEqual(self.consumer.sqs_client.delete_message_batch.call_count, 1)
+        delete_message_batch_call = call(
+            QueueUrl='aws:nest-test-queue-url',
+            Entries=[
+                {'Id': '0', 'ReceiptHandle': 'test-receipt-handle-1'},
+                {'Id': '1', 'ReceiptHandle': 'test-receipt-handle-2'}
+            ]
+        )
+        self.consumer.sqs_client.delete_message_batch.assert_has_calls([delete_message_batch_call])
+
+    def test_failed_acknowledgements_are_retried_and_reported(self):
+        self.consumer.sqs_client.delete_message_batch = MagicMock(side_effect=[
+            {'Successful': [],
+             'Failed': [{'Id': '0', 'SenderFault': False, 'Code': 'InternalError'},
+                        {'Id': '1', 'SenderFault': True, 'Code': 'ReceiptHandleIsInvalid'}]},
+            {'Successful': [{'Id': '0'}], 'Failed': []}
+        ])
+        unacknowledged = self.consumer.acknowledge_data_entries('nest-test-queue', self.messages)
+
+        self.assertEqual([entry['MessageId'] for entry in unacknowledged], ['test-message-id-2'])
+        self.consumer.sqs_client.delete_message_batch.assert_called_with(
+            QueueUrl='aws:nest-test-queue-url',
+            Entries=[{'Id': '0', 'ReceiptHandle': 'test-receipt-handle-1'}]
+        )
+
+    def test_messages_not_forwarded_are_not_acknowledged(self):
+        self.consumer.sqs_client.receive_message = MagicMock(side_effect=[{'Messages': self.messages}, {}])
+        self.consumer.sqs_client.send_message_batch = MagicMock(return_value={
+            'Successful': [{'Id': '0'}],
+            'Failed': [{'Id': '1', 'SenderFault': True, 'Code': 'InvalidMessageContents'}]
+        })
+        self.consumer.sqs_client.delete_message_batch.reset_mock()
+        self.consumer.distribute_data(self.event)
+
+        self.consumer.sqs_client.delete_message_batch.assert_called_once_with(
+            QueueUrl='aws:nest-test-queue-url',
+            Entries=[{'Id': '0', 'ReceiptHandle': 'test-receipt-handle-1'}]
+        )
 
     def test_sending_messages_to_outgoing_queues(self):
-        # Test sending messages out to endpoint queues.
-        self.assertTrue(self.consumer.sqs_client.send_message.called)
-        self.assertEqual(self.consumer.sqs_client.create_queue.call_count,
-                         (len(self.consumer.ec2_client.describe_instances.return_value['Reservations']) + 1) *
-                         len(self.consumer.sqs_client.receive_message.return_value['Messages']))
-        send_message_calls = [
-            call(
-                QueueUrl='aws:nest-test-queue-url',
-                MessageBody='test-body-1'
-            ),
-            call(
-                QueueUrl='aws:nest-test-queue-url',
-                MessageBody='test-body-2'
-            )
-        ]
-        self.consumer.sqs_client.send_message.assert_has_calls(send_message_calls, any_order=True)
+        # Test sending messages out to endpoint queues in one batch per subscriber.
+        self.assertTrue(self.consumer.sqs_client.send_message_batch.called)
+        self.assertEqual(self.consumer.sqs_client.send_message_batch.call_count,
+                         self.consumer.sqs_client.create_queue.call_count)
+        send_message_batch_call = call(
+            QueueUrl='aws:nest-test-queue-url',
+            Entries=[
+                {'Id': '0', 'MessageBody': 'test-body-1'},
+                {'Id': '1', 'MessageBody': 'test-body-2'}
+            ]
+        )
+        self.consumer.sqs_client.send_message_batch.assert_has_calls([send_message_batch_call])
+
+    def test_batching_data_entries(self):
+        # Test that batches respect the SQS entry count and payload size limits
+        entries = [{'Body': 'x'} for _ in range(25)]
+        self.assertEqual([len(b) for b in self.consumer.batch_data_entries(entries)], [10, 10, 5])
+
+        large_body = 'x' * (100 * 1024)
+        entries = [{'Body': large_body} for _ in range(3)]
+        self.assertEqual([len(b) for b in self.consumer.batch_data_entries(entries)], [2, 1])
+
+    def test_failed_entries_are_retried_and_reported(self):
+        self.consumer.sqs_client.send_message_batch = MagicMock(side_effect=[
+            {'Successful': [{'Id': '0'}],
+             'Failed': [{'Id': '1', 'SenderFault': False, 'Code': 'InternalError'},
+                        {'Id': '2', 'SenderFault': True, 'Code': 'InvalidMessageContents'}]},
+            {'Successful': [{'Id': '0'}], 'Failed': []}
+        ])
+        failed = self.consumer.send_data_entries('aws:nest-test-queue-url', self.messages + [
+            {'MessageId': 'test-message-id-3', 'Body': 'test-body-3'}
+        ])
+        self.assertEqual([entry['MessageId'] for entry in failed], ['test-message-id-3'])
+        self.consumer.sqs_client.send_message_batch.assert_called_with(
+            QueueUrl='aws:nest-test-queue-url',
+            Entries=[{'Id': '0', 'MessageBody': 'test-body-2'}]
+        )
 
     def test_topic_creation(self):
         # Check that the outgoing queue notification topics are created
@@ -269,17 +368,203 @@ class NestQueueConsumerTest(unittest.TestCase):
     def test_publishing_to_topic(self):
         # Test publishing the data received from the incoming pipeline into the subscribers of outgoing pipeline
         self.assertTrue(self.consumer.sns_client.publish.called)
-        self.assertEqual(self.consumer.sns_client.publish.call_count,
-                         len(self.consumer.sqs_client.receive_message.return_value['Messages']))
+        # One notification per drain for the archivist queue
+        self.assertEqual(self.consumer.sns_client.publish.call_count, 1)
 
-        publish_calls = [
-            call(
-                TopicArn='arn:aws:sns:eu-west-1:test-account:nest-test-topic',
-                Message="{"\
-                        + "'queue': 'nest-test-queue-persistent_database_writer',"\
-                        + "'dead-letter-queue': 'nest-test-dead-letter-queue-persistent_database_writer'"\
-                        "}"
-            )
-        ]
+        publish_call = call(
+            TopicArn='arn:aws:sns:eu-west-1:test-account:nest-test-topic',
+            Message=json.dumps({
+                'queue': 'nest-test-queue-persistent_database_writer',
+                'dead_letter_queue': 'nest-test-dead-letter-queue-persistent_database_writer',
+                'count': len(self.messages)
+            })
+        )
+        self.consumer.sns_client.publish.assert_has_calls([publish_call])
+
+    def test_outgoing_topic_is_cached(self):
+        self.consumer.sqs_client.receive_message = MagicMock(side_effect=[{'Messages': self.messages}, {}])
+        self.consumer.distribute_data(self.event)
+
+        self.assertEqual(self.consumer.sns_client.create_topic.call_count, 1)
+        self.assertEqual(self.consumer.sns_client.publish.call_count, 2)
+
+    def test_empty_drain_is_not_published(self):
+        self.consumer.sqs_client.receive_message = MagicMock(return_value={})
+        self.consumer.sns_client.publish.reset_mock()
+        self.consumer.distribute_data(self.event)
+
+        self.assertFalse(self.consumer.sns_client.publish.called)
+
+    def test_subscribers_are_cached(self):
+        self.consumer.sqs_client.receive_message = MagicMock(side_effect=[{'Messages': self.messages}, {}])
+        self.consumer.distribute_data(self.event)
+
+        self.assertEqual(self.consumer.ec2_client.describe_instances.call_count, 1)
+
+    def test_subscriber_sources(self):
+        registry = nest_queue_consumer.SubscriberRegistry(
+            ttl=300,
+            sources=['ec2', 'environment', 'static'],
+            static_subscribers=['persistent_database_writer']
+        )
+        with patch.dict(os.environ, {'SUBSCRIBERS': 'extra-subscriber, persistent_database_writer'}):
+            subscribers = registry.get_subscribers(self.consumer)
+
+        self.assertEqual(subscribers, [
+            'master-demo-f914fa', 'development-demo-a57f82', 'extra-subscriber', 'persistent_database_writer'
+        ])
+
+    def test_paginating_ec2_instances(self):
+        first_page = dict(self.consumer.ec2_client.describe_instances.return_value, NextToken='test-token')
+        second_page = {'Reservations': [{'Instances': [
+            {'Tags': [{'Key': 'opsworks:instance', 'Value': 'master-demo-c0ffee'}]}
+        ]}]}
+        self.consumer.ec2_client.describe_instances = MagicMock(side_effect=[first_page, second_page])
+
+        deploy_ids = self.consumer.get_ec2_instances('demo')
+
+        self.assertEqual(deploy_ids, ['master-demo-f914fa', 'development-demo-a57f82', 'master-demo-c0ffee'])
+        self.consumer.ec2_client.describe_instances.assert_called_with(
+            NextToken='test-token',
+            Filters=[{'Name': 'tag:meerkat:task', 'Values': ['demo']}]
+        )
+
+    def test_concurrent_fan_out(self):
+        self.consumer.fanout_workers = 4
+        self.consumer.sqs_client.receive_message = MagicMock(side_effect=[{'Messages': self.messages}, {}])
+        self.consumer.sqs_client.send_message_batch.reset_mock()
+        self.consumer.sqs_client.delete_message_batch.reset_mock()
+        self.consumer.distribute_data(self.event)
+
+        self.assertEqual(self.consumer.sqs_client.send_message_batch.call_count, 4)
+        self.consumer.sqs_client.delete_message_batch.assert_called_once_with(
+            QueueUrl='aws:nest-test-queue-url',
+            Entries=[
+                {'Id': '0', 'ReceiptHandle': 'test-receipt-handle-1'},
+                {'Id': '1', 'ReceiptHandle': 'test-receipt-handle-2'}
+            ]
+        )
+
+    def test_fan_out_pool_is_shared_between_pages(self):
+        self.consumer.fanout_workers = 4
+        self.consumer.sqs_client.receive_message = MagicMock(side_effect=[
+            {'Messages': self.messages[:1]}, {'Messages': self.messages[1:]}, {}
+        ])
+        with patch.object(nest_queue_consumer, 'ThreadPoolExecutor',
+                          wraps=nest_queue_consumer.ThreadPoolExecutor) as executor_class, \
+                patch.dict(nest_queue_consumer.fanout_executors, clear=True):
+            self.consumer.distribute_data(self.event)
+            self.assertIs(nest_queue_consumer.get_fanout_executor(4), nest_queue_consumer.fanout_executors[4])
+
+        executor_class.assert_called_once_with(max_workers=4)
+
+    def test_client_pool_fits_the_fan_out_workers(self):
+        with patch.dict(os.environ, {'FANOUT_WORKERS': '16', 'BOTO_MAX_POOL_CONNECTIONS': '10'}), \
+                patch.dict(nest_queue_consumer.clients, clear=True), \
+                patch.object(nest_queue_consumer.boto3, 'client') as client:
+            nest_queue_consumer.get_client('sqs')
+
+        self.assertEqual(client.call_args[1]['config'].max_pool_connections, 16)
+
+    def test_failing_subscriber_blocks_acknowledgement(self):
+        self.consumer.fanout_workers = 4
+        self.consumer.sqs_client.receive_message = MagicMock(side_effect=[{'Messages': self.messages}, {}])
+        throttled_error = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'ThrottlingException'}}, 'SendMessageBatch')
+        self.consumer.sqs_client.send_message_batch = MagicMock(side_effect=[
+            {'Successful': [], 'Failed': []}, throttled_error,
+            {'Successful': [], 'Failed': []}, {'Successful': [], 'Failed': []}
+        ])
+        self.consumer.sqs_client.delete_message_batch.reset_mock()
+        self.consumer.distribute_data(self.event)
+
+        self.assertFalse(self.consumer.sqs_client.delete_message_batch.called)
+
+    def test_pages_are_acknowledged_as_they_arrive(self):
+        self.consumer.sqs_client.receive_message = MagicMock(side_effect=[
+            {'Messages': self.messages[:1]}, {'Messages': self.messages[1:]}, {}
+        ])
+        self.consumer.sqs_client.delete_message_batch.reset_mock()
+        self.consumer.sns_client.publish.reset_mock()
+        work_remaining = self.consumer.distribute_data(self.event)
+
+        self.assertFalse(work_remaining)
+        self.assertEqual(self.consumer.sqs_client.delete_message_batch.call_count, 2)
+        self.assertEqual(self.consumer.sns_client.publish.call_count, 1)
+
+    def test_forwarded_pages_are_announced_when_a_later_page_fails(self):
+        receive_error = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'ServiceUnavailable'}}, 'ReceiveMessage')
+        self.consumer.sqs_client.receive_message = MagicMock(side_effect=[
+            {'Messages': self.messages[:1]}, receive_error
+        ])
+        self.consumer.sns_client.publish.reset_mock()
+
+        with self.assertRaises(botocore.exceptions.ClientError):
+            self.consumer.distribute_data(self.event)
+
+        self.consumer.sns_client.publish.assert_called_once_with(
+            TopicArn='arn:aws:sns:eu-west-1:test-account:nest-test-topic',
+            Message=json.dumps({
+                'queue': 'nest-test-queue-persistent_database_writer',
+                'dead_letter_queue': 'nest-test-dead-letter-queue-persistent_database_writer',
+                'count': 1
+            })
+        )
+
+    def test_drain_stops_before_timeout_and_retriggers(self):
+        context = MagicMock()
+        context.get_remaining_time_in_millis = MagicMock(return_value=5000)
+        self.consumer.sqs_client.receive_message = MagicMock(side_effect=[
+            {'Messages': self.messages[:1]}, {'Messages': self.messages[1:]}, {}
+        ])
+        self.consumer.sns_client.publish.reset_mock()
+        work_remaining = self.consumer.distribute_data(self.event, context)
+
+        self.assertTrue(work_remaining)
+        self.assertEqual(self.consumer.sqs_client.receive_message.call_count, 1)
+        # Archivist notification and the new trigger for the incoming queue
+        self.assertEqual(self.consumer.sns_client.publish.call_count, 2)
+        self.consumer.sns_client.create_topic.assert_called_with(Name='nest-incoming-topic-demo')
+        self.consumer.sns_client.publish.assert_called_with(
+            TopicArn='arn:aws:sns:eu-west-1:test-account:nest-test-topic',
+            Message=json.dumps(self.event)
+        )
+
+    def test_handler_coalesces_records_by_queue(self):
+        other_event = {'queue': 'nest-other-queue', 'dead-letter-queue': 'nest-other-dead-letter-queue'}
+        event = {'Records': [
+            {'Sns': {'Message': json.dumps(self.event)}},
+            {'Sns': {'Message': json.dumps(other_event)}},
+            {'Sns': {'Message': json.dumps(self.event)}}
+        ]}
+        with patch.object(nest_queue_consumer.NestQueueConsumer, 'distribute_data') as distribute_data:
+            nest_queue_consumer.lambda_handler(event, None)
+
+        self.assertEqual(distribute_data.call_args_list, [call(self.event, None), call(other_event, None)])
+
+    def test_sqs_event_source_batch(self):
+        event = {'Records': [
+            {
+                'messageId': message['MessageId'],
+                'receiptHandle': message['ReceiptHandle'],
+                'body': message['Body'],
+                'attributes': {},
+                'eventSource': 'aws:sqs',
+                'eventSourceARN': 'arn:aws:sqs:eu-west-1:test-account:nest-test-queue'
+            }
+            for message in self.messages
+        ]}
+        self.consumer.sqs_client.send_message_batch = MagicMock(return_value={
+            'Successful': [{'Id': '0'}],
+            'Failed': [{'Id': '1', 'SenderFault': True, 'Code': 'InvalidMessageContents'}]
+        })
+        self.consumer.sqs_client.receive_message.reset_mock()
+        self.consumer.sqs_client.delete_message_batch.reset_mock()
+
+        response = nest_queue_consumer.sqs_lambda_handler(event, None)
 
-        #self.consumer.sns_client.publish.assert_has_calls(publish_calls, any_order=True)
+        self.assertEqual(response, {'batchItemFailures': [{'itemIdentifier': 'test-message-id-2'}]})
+        # Messages are deleted by the event source mapping instead of polled and acknowledged here
+        self.assertFalse(self.consumer.sqs_client.receive_message.called)
+        self.assertFalse(self.consumer.sqs_client.delete_message_batch.called)
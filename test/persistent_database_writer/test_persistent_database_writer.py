@@ -1,6 +1,6 @@
 import unittest
 import json
-from unittest.mock import MagicMock, call
+from unittest.mock import MagicMock, call, patch
 
 import uuid
 
@@ -56,7 +56,10 @@ class PersistentDatabaseWriter(unittest.TestCase):
                 }
             ]
         })
-        self.writer.sqs_client.delete_message = MagicMock(return_value=None)
+        self.writer.sqs_client.delete_message_batch = MagicMock(return_value={
+            'Successful': [],
+            'Failed': []
+        })
 
         # Call data storage function
         self.writer.store_data_entries()
@@ -78,3 +81,673 @@ class PersistentDatabaseWriter(unittest.TestCase):
         # for insert_call in self.writer.session.add.call_args_list:
         #     self.assertTrue(insert_call[0][0].uuid == 'test-uuid-1234')
         #     self.assertTrue(insert_call[0][0].data == upload_payload['data'][0])
+
+
+class AcknowledgementStageTest(unittest.TestCase):
+    def setUp(self):
+        self.sqs_client = MagicMock()
+        self.sqs_client.delete_message_batch = MagicMock(return_value={'Successful': [], 'Failed': []})
+        self.messages = [
+            {'MessageId': 'test-message-id-{0}'.format(i), 'ReceiptHandle': 'test-receipt-handle-{0}'.format(i)}
+            for i in range(25)
+        ]
+
+    def test_flushing_in_batches(self):
+        acknowledgements = persistent_database_writer.AcknowledgementStage(self.sqs_client, 'aws:nest-test-queue-url')
+        for message in self.messages:
+            acknowledgements.add(message)
+        # Full batches are flushed as soon as they are collected
+        self.assertEqual(self.sqs_client.delete_message_batch.call_count, 2)
+
+        unacknowledged = acknowledgements.flush()
+
+        self.assertEqual(unacknowledged, [])
+        self.assertEqual(self.sqs_client.delete_message_batch.call_count, 3)
+        last_entries = self.sqs_client.delete_message_batch.call_args[1]['Entries']
+        self.assertEqual([entry['ReceiptHandle'] for entry in last_entries],
+                         ['test-receipt-handle-{0}'.format(i) for i in range(20, 25)])
+
+    def test_reporting_unacknowledged_messages(self):
+        self.sqs_client.delete_message_batch = MagicMock(return_value={
+            'Successful': [],
+            'Failed': [{'Id': '0', 'SenderFault': False, 'Code': 'InternalError'}]
+        })
+        acknowledgements = persistent_database_writer.AcknowledgementStage(
+            self.sqs_client, 'aws:nest-test-queue-url', max_attempts=2)
+        acknowledgements.add(self.messages[0])
+
+        unacknowledged = acknowledgements.flush()
+
+        self.assertEqual(unacknowledged, [self.messages[0]])
+        self.assertEqual(self.sqs_client.delete_message_batch.call_count, 2)
+
+
+class LambdaHandlerTest(unittest.TestCase):
+    def setUp(self):
+        persistent_database_writer.db_connections.close_all()
+
+    def test_records_are_coalesced_by_queue(self):
+        message = {'queue': 'nest-test-queue-persistent_database_writer',
+                   'dead_letter_queue': 'nest-test-dead-letter-queue-persistent_database_writer'}
+        event = {'Records': [{'Sns': {'Message': json.dumps(message)}} for _ in range(3)]}
+        with patch.object(persistent_database_writer.PersistentDatabaseWriter, 'drain_queue',
+                          return_value=False) as drain_queue:
+            persistent_database_writer.lambda_handler(event, None)
+
+        drain_queue.assert_called_once_with('nest-test-queue-persistent_database_writer', None,
+                                            'nest-test-dead-letter-queue-persistent_database_writer')
+
+    def test_default_queue_without_records(self):
+        with patch.dict('os.environ', {'PERSISTENT_DATABASE_WRITER_QUEUE': 'nest-test-queue-writer'}):
+            notifications = persistent_database_writer.get_notifications({})
+
+        self.assertEqual(notifications, [{'queue': 'nest-test-queue-writer'}])
+
+    def test_sqs_event_source_batch(self):
+        event = {'Records': [
+            {'messageId': 'test-message-id-1', 'receiptHandle': 'test-receipt-handle-1',
+             'body': json.dumps({'formId': 'dem_test', 'data': {'meta/instanceID': 'uuid:test-1'}}),
+             'attributes': {}},
+            {'messageId': 'test-message-id-2', 'receiptHandle': 'test-receipt-handle-2',
+             'body': 'not json', 'attributes': {}}
+        ]}
+        db_conn = MagicMock()
+        with patch.object(persistent_database_writer.psycopg2, 'connect', return_value=db_conn):
+            response = persistent_database_writer.sqs_lambda_handler(event, None)
+
+        self.assertEqual(response, {'batchItemFailures': [{'itemIdentifier': 'test-message-id-2'}]})
+        self.assertEqual(db_conn.commit.call_count, 1)
+
+    def test_sqs_event_source_uses_bulk_write(self):
+        event = {'Records': [
+            {'messageId': 'test-message-id-{0}'.format(i), 'receiptHandle': 'test-receipt-handle-{0}'.format(i),
+             'body': json.dumps({'formId': 'dem_test', 'data': {'meta/instanceID': 'uuid:test-{0}'.format(i)}}),
+             'attributes': {}}
+            for i in range(3)
+        ]}
+        db_conn = MagicMock()
+        with patch.dict(persistent_database_writer.os.environ, {'BULK_WRITE': 'true'}), \
+                patch.object(persistent_database_writer.psycopg2, 'connect', return_value=db_conn), \
+                patch.object(persistent_database_writer.psycopg2.extras, 'execute_values') as execute_values:
+            response = persistent_database_writer.sqs_lambda_handler(event, None)
+
+        self.assertEqual(response, {'batchItemFailures': []})
+        execute_values.assert_called_once()
+        self.assertEqual(db_conn.commit.call_count, 1)
+
+
+class BulkWriteTest(unittest.TestCase):
+    def setUp(self):
+        persistent_database_writer.db_connections.close_all()
+        self.writer = persistent_database_writer.PersistentDatabaseWriter()
+        self.writer.bulk_write = True
+        self.data_entries = [
+            {'formId': 'dem_test', 'data': {'meta/instanceID': 'uuid:test-1'}},
+            {'formId': 'reg_test', 'data': {'meta/instanceID': 'uuid:test-2'}},
+            {'formId': 'dem_test', 'data': {'meta/instanceID': 'uuid:test-3'}}
+        ]
+
+    def test_one_statement_per_form(self):
+        db_cur = MagicMock()
+        with patch.object(persistent_database_writer.psycopg2.extras, 'execute_values') as execute_values:
+            self.writer.write_batch_to_db(db_cur, self.data_entries)
+
+        self.assertEqual(execute_values.call_count, 2)
+        dem_call = execute_values.call_args_list[0]
+        self.assertIn('INSERT INTO dem_test', dem_call[0][1])
+        self.assertEqual([row[0] for row in dem_call[0][2]], ['uuid:test-1', 'uuid:test-3'])
+        self.assertEqual(dem_call[1], {'page_size': 2})
+
+    def test_one_transaction_per_batch(self):
+        messages = [
+            {'MessageId': 'test-message-id-{0}'.format(i), 'ReceiptHandle': 'test-receipt-handle-{0}'.format(i),
+             'Body': json.dumps(data_entry)}
+            for i, data_entry in enumerate(self.data_entries)
+        ]
+        self.writer.sqs_client = MagicMock()
+        self.writer.sqs_client.get_queue_url = MagicMock(return_value={'QueueUrl': 'aws:nest-test-queue-url'})
+        self.writer.sqs_client.receive_message = MagicMock(side_effect=[{'Messages': messages}, {}])
+        self.writer.sqs_client.delete_message_batch = MagicMock(return_value={'Successful': [], 'Failed': []})
+        db_conn = MagicMock()
+        with patch.object(persistent_database_writer.psycopg2, 'connect', return_value=db_conn), \
+                patch.object(persistent_database_writer.psycopg2.extras, 'execute_values'):
+            self.writer.store_data_entries('nest-test-queue')
+
+        self.assertEqual(db_conn.commit.call_count, 1)
+        self.writer.sqs_client.delete_message_batch.assert_called_once()
+
+
+class DatabaseConnectionHolderTest(unittest.TestCase):
+    def create_connection(self):
+        db_conn = MagicMock()
+        db_conn.closed = 0
+        db_conn.get_transaction_status = MagicMock(
+            return_value=persistent_database_writer.psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+        return db_conn
+
+    def setUp(self):
+        self.connect = MagicMock(side_effect=lambda: self.create_connection())
+        self.holder = persistent_database_writer.DatabaseConnectionHolder(self.connect)
+
+    def test_connection_is_reused(self):
+        with self.holder.connection() as first_conn:
+            pass
+        with self.holder.connection() as second_conn:
+            pass
+
+        self.assertIs(first_conn, second_conn)
+        self.assertEqual(self.connect.call_count, 1)
+
+    def test_reconnecting_after_server_side_timeout(self):
+        with self.holder.connection() as first_conn:
+            pass
+        first_conn.cursor.return_value.__enter__.return_value.execute = MagicMock(
+            side_effect=persistent_database_writer.psycopg2.OperationalError('server closed the connection'))
+
+        with self.holder.connection() as second_conn:
+            pass
+
+        self.assertIsNot(first_conn, second_conn)
+        self.assertTrue(first_conn.close.called)
+        self.assertEqual(self.connect.call_count, 2)
+
+    def test_broken_connection_is_discarded(self):
+        with self.assertRaises(persistent_database_writer.psycopg2.OperationalError):
+            with self.holder.connection() as db_conn:
+                raise persistent_database_writer.psycopg2.OperationalError('terminating connection')
+
+        self.assertTrue(db_conn.close.called)
+        self.assertEqual(self.holder.idle, [])
+
+
+class DeduplicationTest(unittest.TestCase):
+    def setUp(self):
+        self.writer = persistent_database_writer.PersistentDatabaseWriter()
+
+    def create_message(self, message_id, instance_id, sent_timestamp, value):
+        return {
+            'MessageId': message_id,
+            'ReceiptHandle': 'receipt-' + message_id,
+            'Body': json.dumps({'formId': 'dem_test', 'data': {'meta/instanceID': instance_id, 'value': value}}),
+            'Attributes': {'SentTimestamp': str(sent_timestamp)}
+        }
+
+    def test_last_write_wins(self):
+        messages = [
+            self.create_message('1', 'uuid:a', 200, 'newest'),
+            self.create_message('2', 'uuid:b', 100, 'only'),
+            self.create_message('3', 'uuid:a', 100, 'oldest'),
+            self.create_message('4', 'uuid:a', 200, 'received last')
+        ]
+        groups = self.writer.group_duplicates(messages)
+
+        self.assertEqual([[m['MessageId'] for m in group] for group in groups], [['3', '1', '4'], ['2']])
+        self.assertEqual(self.writer.duplicate_count, 2)
+
+    def test_entries_without_instance_id_are_not_merged(self):
+        messages = [
+            {'MessageId': '1', 'Body': json.dumps({'formId': 'dem_test', 'data': {}})},
+            {'MessageId': '2', 'Body': json.dumps({'formId': 'dem_test', 'data': {}})},
+            {'MessageId': '3', 'Body': 'not json'}
+        ]
+        groups = self.writer.group_duplicates(messages)
+
+        self.assertEqual(len(groups), 3)
+        self.assertEqual(self.writer.duplicate_count, 0)
+
+    def test_bulk_write_skips_duplicates_and_acknowledges_all(self):
+        self.writer.bulk_write = True
+        messages = [self.create_message('1', 'uuid:a', 100, 'old'), self.create_message('2', 'uuid:a', 200, 'new')]
+        acknowledgements = MagicMock()
+        with patch.object(persistent_database_writer.psycopg2.extras, 'execute_values') as execute_values:
+            self.writer.write_data_entries(MagicMock(), messages, acknowledgements)
+
+        rows = execute_values.call_args[0][2]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(json.loads(rows[0][1])['value'], 'new')
+        self.assertEqual(acknowledgements.add.call_count, 2)
+
+
+class UploadPayloadTest(unittest.TestCase):
+    def setUp(self):
+        self.writer = persistent_database_writer.PersistentDatabaseWriter()
+        self.data_entry = {
+            'formId': 'dem_test',
+            'data': [
+                dict(upload_payload['data'][0]),
+                {'*meta-instance-id*': 'uuid:test-2', 'today': '2017-06-23'},
+                {'meta/instanceID': 'uuid:test-3', 'today': '2017-06-24'}
+            ]
+        }
+
+    def test_one_row_per_record(self):
+        rows = self.writer.get_rows(self.data_entry)
+
+        self.assertEqual([row[0] for row in rows],
+                         ['uuid:75099745-d218-4129-8b27-de3520c1281a', 'uuid:test-2', 'uuid:test-3'])
+        self.assertEqual(json.loads(rows[1][1]), self.data_entry['data'][1])
+
+    def test_records_are_written_in_one_statement(self):
+        db_cur = MagicMock()
+        with patch.object(persistent_database_writer.psycopg2.extras, 'execute_values') as execute_values:
+            self.writer.write_to_db(db_cur, self.data_entry)
+
+        execute_values.assert_called_once()
+        self.assertEqual(len(execute_values.call_args[0][2]), 3)
+        self.assertEqual(execute_values.call_args[1], {'page_size': 3})
+        self.assertFalse(db_cur.execute.called)
+
+    def test_repeated_records_are_written_once(self):
+        self.writer.bulk_write = True
+        messages = [
+            {'MessageId': str(i), 'ReceiptHandle': 'receipt-{0}'.format(i), 'Body': json.dumps(self.data_entry)}
+            for i in range(2)
+        ]
+        messages[1]['Body'] = json.dumps({'formId': 'dem_test', 'data': self.data_entry['data'][1:]})
+        acknowledgements = MagicMock()
+        with patch.object(persistent_database_writer.psycopg2.extras, 'execute_values') as execute_values:
+            self.writer.write_data_entries(MagicMock(), messages, acknowledgements)
+
+        execute_values.assert_called_once()
+        self.assertEqual(len(execute_values.call_args[0][2]), 3)
+        self.assertEqual(acknowledgements.add.call_count, 2)
+
+
+class ContentHashTest(unittest.TestCase):
+    def setUp(self):
+        self.writer = persistent_database_writer.PersistentDatabaseWriter()
+        self.writer.content_hash = True
+        self.data_entry = {'formId': 'dem_test', 'data': {'meta/instanceID': 'uuid:test-1'}}
+
+    def test_hash_is_stored_with_the_row(self):
+        uuid_new, data, data_hash = self.writer.get_record_row(self.data_entry['data'])
+
+        self.assertEqual(uuid_new, 'uuid:test-1')
+        self.assertEqual(data_hash, persistent_database_writer.hashlib.sha256(data.encode('utf-8')).hexdigest())
+
+    def test_unchanged_rows_are_skipped(self):
+        db_cur = MagicMock()
+        db_cur.rowcount = 0
+        self.writer.write_to_db(db_cur, self.data_entry)
+
+        statement = db_cur.execute.call_args[0][0]
+        self.assertIn('WHERE dem_test.DATA_HASH IS DISTINCT FROM EXCLUDED.DATA_HASH', statement)
+        self.assertEqual(self.writer.skipped_write_count, 1)
+
+    def test_skipped_rows_are_counted_in_bulk(self):
+        db_cur = MagicMock()
+        db_cur.rowcount = 1
+        data_entries = [self.data_entry, {'formId': 'dem_test', 'data': {'meta/instanceID': 'uuid:test-2'}}]
+        with patch.object(persistent_database_writer.psycopg2.extras, 'execute_values'):
+            self.writer.write_batch_to_db(db_cur, data_entries)
+
+        self.assertEqual(self.writer.skipped_write_count, 1)
+
+    def test_skipped_rows_are_in_the_drain_summary(self):
+        db_cur = MagicMock()
+        db_cur.rowcount = 1
+        self.writer.count_skipped_writes(db_cur, 3)
+        with self.assertLogs('persistent_database_writer.summary', level='WARNING') as logs:
+            self.writer.log_summary('nest-test-queue')
+
+        self.assertIn('skipped_writes=2', logs.output[0])
+
+
+class ContinuousDrainTest(unittest.TestCase):
+    def setUp(self):
+        persistent_database_writer.db_connections.close_all()
+        self.writer = persistent_database_writer.PersistentDatabaseWriter()
+        self.writer.max_number_of_messages = 15
+        self.writer.sqs_client = MagicMock()
+        self.writer.sns_client = MagicMock()
+        self.writer.sqs_client.get_queue_url = MagicMock(return_value={'QueueUrl': 'aws:nest-test-queue-url'})
+        self.writer.sqs_client.delete_message_batch = MagicMock(return_value={'Successful': [], 'Failed': []})
+        self.messages = [
+            {'MessageId': 'test-message-id-{0}'.format(i), 'ReceiptHandle': 'test-receipt-handle-{0}'.format(i),
+             'Body': json.dumps({'formId': 'dem_test', 'data': {'meta/instanceID': 'uuid:test-{0}'.format(i)}})}
+            for i in range(40)
+        ]
+
+    def test_batches_larger_than_ten(self):
+        self.writer.sqs_client.receive_message = MagicMock(side_effect=[
+            {'Messages': self.messages[0:10]}, {'Messages': self.messages[10:15]}
+        ])
+        with patch.object(persistent_database_writer.psycopg2, 'connect'):
+            call_again = self.writer.store_data_entries('nest-test-queue')
+
+        self.assertTrue(call_again)
+        self.assertEqual(self.writer.sqs_client.receive_message.call_args[1]['MaxNumberOfMessages'], 5)
+
+    def test_draining_until_the_queue_is_empty(self):
+        self.writer.sqs_client.receive_message = MagicMock(side_effect=[
+            {'Messages': self.messages[0:10]}, {'Messages': self.messages[10:15]},
+            {'Messages': self.messages[15:25]}, {'Messages': self.messages[25:30]},
+            {'Messages': self.messages[30:35]}, {}
+        ])
+        with patch.object(persistent_database_writer.psycopg2, 'connect'):
+            work_remaining = self.writer.drain_queue('nest-test-queue')
+
+        self.assertFalse(work_remaining)
+        self.assertEqual(self.writer.sqs_client.receive_message.call_count, 6)
+
+    def test_drain_summary_is_logged_once(self):
+        self.writer.sqs_client.receive_message = MagicMock(side_effect=[
+            {'Messages': self.messages[0:10] + self.messages[0:2]}, {}
+        ])
+        with patch.object(persistent_database_writer.psycopg2, 'connect'), \
+                self.assertLogs('persistent_database_writer.summary', level='WARNING') as logs:
+            self.writer.drain_queue('nest-test-queue')
+
+        self.assertEqual(logs.output, [
+            'WARNING:persistent_database_writer.summary:'
+            'Drain summary for nest-test-queue: handled=12 duplicates=2 skipped_writes=0 dead_lettered=0'
+        ])
+
+    def test_retriggering_when_out_of_time(self):
+        context = MagicMock()
+        context.get_remaining_time_in_millis = MagicMock(return_value=5000)
+        self.writer.sqs_client.receive_message = MagicMock(side_effect=[
+            {'Messages': self.messages[0:10]}, {'Messages': self.messages[10:15]}
+        ])
+        message = {'queue': 'nest-test-queue', 'dead_letter_queue': 'nest-test-dead-letter-queue'}
+        event = {'Records': [{'Sns': {'TopicArn': 'arn:aws:sns:eu-west-1:test-account:nest-outgoing-topic-demo',
+                                      'Message': json.dumps(message)}}]}
+        with patch.object(persistent_database_writer, 'get_client',
+                          side_effect=lambda service: {'sqs': self.writer.sqs_client,
+                                                       'sns': self.writer.sns_client}[service]), \
+                patch.object(persistent_database_writer.psycopg2, 'connect'):
+            persistent_database_writer.lambda_handler(event, context)
+
+        self.writer.sns_client.publish.assert_called_once_with(
+            TopicArn='arn:aws:sns:eu-west-1:test-account:nest-outgoing-topic-demo',
+            Message=json.dumps(message)
+        )
+
+    def test_parallel_receivers_fill_one_bounded_batch(self):
+        self.writer.receive_workers = 3
+        self.writer.max_number_of_messages = 25
+        pages = iter([self.messages[i:i + 10] for i in range(0, 40, 10)])
+        lock = persistent_database_writer.threading.Lock()
+
+        def receive_message(**kwargs):
+            with lock:
+                page = next(pages, [])
+            return {'Messages': page[:kwargs['MaxNumberOfMessages']]}
+
+        self.writer.sqs_client.receive_message = MagicMock(side_effect=receive_message)
+        data_entries = self.writer.receive_batch('nest-test-queue')
+
+        self.assertEqual(len(data_entries), 25)
+        self.assertEqual(len(set(m['MessageId'] for m in data_entries)), 25)
+        for receive_call in self.writer.sqs_client.receive_message.call_args_list:
+            self.assertLessEqual(receive_call[1]['MaxNumberOfMessages'], 10)
+        self.assertEqual(self.writer.sqs_client.get_queue_url.call_count, 1)
+
+
+class PoisonMessageTest(unittest.TestCase):
+    def setUp(self):
+        self.writer = persistent_database_writer.PersistentDatabaseWriter()
+        self.writer.bulk_write = True
+        self.writer.sqs_client = MagicMock()
+        self.writer.sqs_client.create_queue = MagicMock(return_value={'QueueUrl': 'aws:nest-test-dead-letter-url'})
+        self.writer.sqs_client.send_message_batch = MagicMock(
+            side_effect=lambda QueueUrl, Entries: {'Successful': [{'Id': e['Id']} for e in Entries], 'Failed': []})
+        self.acknowledgements = MagicMock()
+        instance_ids = ['uuid:1', 'uuid:2', 'uuid:bad', 'uuid:4', 'uuid:5']
+        self.messages = [
+            {'MessageId': instance_id, 'ReceiptHandle': 'receipt-' + instance_id,
+             'Body': json.dumps({'formId': 'dem_test', 'data': {'meta/instanceID': instance_id}})}
+            for instance_id in instance_ids
+        ]
+        self.messages.append({'MessageId': 'malformed', 'ReceiptHandle': 'receipt-malformed', 'Body': '{"data": {}}'})
+
+    def execute_values(self, db_cur, statement, rows, page_size):
+        if any(row[0] == 'uuid:bad' for row in rows):
+            raise persistent_database_writer.psycopg2.DataError('invalid input syntax for type json')
+
+    def test_bad_entries_are_isolated(self):
+        db_conn = MagicMock()
+        with patch.object(persistent_database_writer.psycopg2.extras, 'execute_values',
+                          side_effect=self.execute_values):
+            self.writer.write_data_entries(db_conn, self.messages, self.acknowledgements,
+                                           'nest-test-dead-letter-queue')
+
+        self.assertEqual(db_conn.commit.call_count, 1)
+        acknowledged = [c[0][0]['MessageId'] for c in self.acknowledgements.add.call_args_list]
+        self.assertEqual(sorted(acknowledged), sorted(m['MessageId'] for m in self.messages))
+
+        dead_letters = self.writer.sqs_client.send_message_batch.call_args[1]['Entries']
+        self.assertEqual(len(dead_letters), 2)
+        reasons = [entry['MessageAttributes']['ErrorReason']['StringValue'] for entry in dead_letters]
+        self.assertIn('Malformed message body', reasons[0])
+        self.assertEqual(reasons[1], 'invalid input syntax for type json')
+        self.assertEqual(self.writer.dead_letter_count, 2)
+
+    def test_missing_table_is_dead_lettered_whatever_the_batch_size(self):
+        class UndefinedTable(persistent_database_writer.psycopg2.ProgrammingError):
+            pgcode = persistent_database_writer.psycopg2.errorcodes.UNDEFINED_TABLE
+
+        def execute(statement, *args):
+            if 'reg_test' in statement:
+                raise UndefinedTable('relation "reg_test" does not exist')
+
+        def execute_values(db_cur, statement, rows, page_size):
+            execute(statement)
+
+        for missing_count, batch_size in ((1, 3), (2, 3), (1, 1), (3, 3)):
+            messages = [
+                dict(message, Body=json.dumps({'formId': 'reg_test', 'data': {'meta/instanceID': message['MessageId']}}))
+                if position < missing_count else message
+                for position, message in enumerate(self.messages[:batch_size])
+            ]
+            for bulk_write in (True, False):
+                self.writer.bulk_write = bulk_write
+                self.writer.sqs_client.send_message_batch.reset_mock()
+                db_conn = MagicMock()
+                db_conn.cursor.return_value.__enter__.return_value.execute.side_effect = execute
+                with patch.object(persistent_database_writer.psycopg2.extras, 'execute_values',
+                                  side_effect=execute_values):
+                    self.writer.write_data_entries(db_conn, messages, self.acknowledgements,
+                                                   'nest-test-dead-letter-queue')
+
+                dead_letters = self.writer.sqs_client.send_message_batch.call_args[1]['Entries']
+                self.assertEqual([json.loads(entry['MessageBody'])['formId'] for entry in dead_letters],
+                                 ['reg_test'] * missing_count)
+
+    def test_systemic_errors_are_raised_without_acknowledging(self):
+        errors = [
+            persistent_database_writer.psycopg2.ProgrammingError('column "data_hash" does not exist'),
+            persistent_database_writer.psycopg2.DataError('value too long')
+        ]
+        for error in errors:
+            def execute(statement, *args):
+                if 'INSERT' in statement:
+                    raise error
+
+            for bulk_write in (True, False):
+                self.writer.bulk_write = bulk_write
+                self.acknowledgements.reset_mock()
+                db_conn = MagicMock()
+                db_conn.cursor.return_value.__enter__.return_value.execute.side_effect = execute
+                with patch.object(persistent_database_writer.psycopg2.extras, 'execute_values', side_effect=error), \
+                        self.assertRaises(type(error)):
+                    self.writer.write_data_entries(db_conn, self.messages[:5], self.acknowledgements,
+                                                   'nest-test-dead-letter-queue')
+
+                self.assertFalse(self.acknowledgements.add.called)
+                self.assertFalse(self.writer.sqs_client.send_message_batch.called)
+
+    def test_bad_entries_are_not_acknowledged_without_dead_letter_queue(self):
+        with patch.object(persistent_database_writer.psycopg2.extras, 'execute_values',
+                          side_effect=self.execute_values):
+            self.writer.write_data_entries(MagicMock(), self.messages, self.acknowledgements)
+
+        acknowledged = [c[0][0]['MessageId'] for c in self.acknowledgements.add.call_args_list]
+        self.assertEqual(sorted(acknowledged), ['uuid:1', 'uuid:2', 'uuid:4', 'uuid:5'])
+        self.assertFalse(self.writer.sqs_client.send_message_batch.called)
+
+
+class FormSchemaTest(unittest.TestCase):
+    def setUp(self):
+        persistent_database_writer.form_schemas.clear()
+        self.writer = persistent_database_writer.PersistentDatabaseWriter()
+        self.writer.create_tables = True
+        self.writer.bulk_write = True
+        self.messages = [
+            {'MessageId': str(i), 'ReceiptHandle': 'receipt-{0}'.format(i),
+             'Body': json.dumps({'formId': form_id, 'data': {'meta/instanceID': 'uuid:{0}'.format(i)}})}
+            for i, form_id in enumerate(['dem_test', 'dem_test', 'dem_test; DROP TABLE dem_test'])
+        ]
+
+    def tearDown(self):
+        persistent_database_writer.form_schemas.clear()
+
+    def get_statements(self, db_cur):
+        return [c[0][0] for c in db_cur.execute.call_args_list]
+
+    def test_table_is_created_once(self):
+        db_conn = MagicMock()
+        db_cur = db_conn.cursor.return_value.__enter__.return_value
+        db_cur.fetchone.return_value = (None,)
+        acknowledgements = MagicMock()
+        with patch.object(persistent_database_writer.psycopg2.extras, 'execute_values'):
+            self.writer.write_data_entries(db_conn, self.messages[:2], acknowledgements)
+            self.writer.write_data_entries(db_conn, self.messages[:2], acknowledgements)
+
+        ddl_statements = [s for s in self.get_statements(db_cur) if s.startswith(('SELECT', 'CREATE'))]
+        self.assertEqual(ddl_statements, [
+            'SELECT to_regclass(%s);',
+            'CREATE TABLE dem_test (UUID VARCHAR PRIMARY KEY, DATA JSONB NOT NULL);',
+            'CREATE INDEX dem_test_data_idx ON dem_test USING GIN (DATA jsonb_path_ops);'
+        ])
+        self.assertIn('dem_test', persistent_database_writer.form_schemas.known_tables)
+
+    def test_existing_table_is_left_unchanged(self):
+        self.writer.content_hash = True
+        db_conn = MagicMock()
+        db_cur = db_conn.cursor.return_value.__enter__.return_value
+        db_cur.fetchone.return_value = ('dem_test',)
+        db_cur.rowcount = 2
+        with patch.object(persistent_database_writer.psycopg2.extras, 'execute_values'):
+            self.writer.write_data_entries(db_conn, self.messages[:2], MagicMock())
+            self.writer.write_data_entries(db_conn, self.messages[:2], MagicMock())
+
+        statements = self.get_statements(db_cur)
+        self.assertEqual(statements.count('SELECT to_regclass(%s);'), 1)
+        self.assertFalse(any(s.startswith(('CREATE', 'ALTER')) for s in statements))
+        self.assertIn('dem_test', persistent_database_writer.form_schemas.known_tables)
+
+    def test_table_is_not_known_after_rollback(self):
+        db_cur = MagicMock()
+        db_cur.fetchone.return_value = (None,)
+        self.writer.prepare_form_table(db_cur, 'dem_test')
+        self.writer.rollback(MagicMock())
+
+        self.assertNotIn('dem_test', persistent_database_writer.form_schemas.known_tables)
+
+    def test_invalid_form_id_is_rejected(self):
+        db_conn = MagicMock()
+        db_cur = db_conn.cursor.return_value.__enter__.return_value
+        acknowledgements = MagicMock()
+        with patch.object(persistent_database_writer.psycopg2.extras, 'execute_values') as execute_values:
+            self.writer.write_data_entries(db_conn, self.messages, acknowledgements)
+
+        self.assertFalse(any('DROP' in statement for statement in self.get_statements(db_cur)))
+        self.assertFalse(any('DROP' in c[0][1] for c in execute_values.call_args_list))
+        self.assertEqual(sorted(c[0][0]['MessageId'] for c in acknowledgements.add.call_args_list), ['0', '1'])
+
+    def ddl_error(self, base, pgcode):
+        error_type = type('DatabaseError', (base,), {'pgcode': pgcode})
+
+        def execute(statement, *args):
+            if statement.startswith('CREATE TABLE'):
+                raise error_type('error {0}'.format(pgcode))
+        return execute
+
+    def test_concurrently_created_table_counts_as_created(self):
+        for pgcode in ('23505', '42P07'):
+            persistent_database_writer.form_schemas.clear()
+            db_conn = MagicMock()
+            db_cur = db_conn.cursor.return_value.__enter__.return_value
+            db_cur.fetchone.return_value = (None,)
+            db_cur.execute.side_effect = self.ddl_error(persistent_database_writer.psycopg2.IntegrityError, pgcode)
+            acknowledgements = MagicMock()
+            with patch.object(persistent_database_writer.psycopg2.extras, 'execute_values') as execute_values:
+                self.writer.write_data_entries(db_conn, self.messages[:2], acknowledgements,
+                                               'nest-test-dead-letter-queue')
+
+            execute_values.assert_called_once()
+            self.assertEqual(acknowledgements.add.call_count, 2)
+            self.assertIn("ROLLBACK TO SAVEPOINT create_table;", self.get_statements(db_cur))
+            self.assertFalse(any(s.startswith('CREATE INDEX') for s in self.get_statements(db_cur)))
+            self.assertIn('dem_test', persistent_database_writer.form_schemas.known_tables)
+
+    def test_table_creation_failure_is_not_a_poison_message(self):
+        for bulk_write in (True, False):
+            persistent_database_writer.form_schemas.clear()
+            self.writer.bulk_write = bulk_write
+            self.writer.sqs_client = MagicMock()
+            db_conn = MagicMock()
+            db_cur = db_conn.cursor.return_value.__enter__.return_value
+            db_cur.fetchone.return_value = (None,)
+            db_cur.execute.side_effect = self.ddl_error(persistent_database_writer.psycopg2.ProgrammingError, '42501')
+            acknowledgements = MagicMock()
+            with self.assertRaises(persistent_database_writer.psycopg2.ProgrammingError):
+                self.writer.write_data_entries(db_conn, self.messages[:2], acknowledgements,
+                                               'nest-test-dead-letter-queue')
+
+            self.assertFalse(acknowledgements.add.called)
+            self.assertFalse(self.writer.sqs_client.send_message_batch.called)
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        persistent_database_writer.db_connections.close_all()
+        self.writer = persistent_database_writer.PersistentDatabaseWriter()
+        self.writer.pipeline_depth = 1
+        self.writer.max_number_of_messages = 10
+        self.writer.bulk_write = True
+        self.writer.sqs_client = MagicMock()
+        self.writer.sqs_client.get_queue_url = MagicMock(return_value={'QueueUrl': 'aws:nest-test-queue-url'})
+        self.writer.sqs_client.delete_message_batch = MagicMock(return_value={'Successful': [], 'Failed': []})
+        self.messages = [
+            {'MessageId': 'test-message-id-{0}'.format(i), 'ReceiptHandle': 'test-receipt-handle-{0}'.format(i),
+             'Body': json.dumps({'formId': 'dem_test', 'data': {'meta/instanceID': 'uuid:test-{0}'.format(i)}})}
+            for i in range(25)
+        ]
+        self.writer.sqs_client.receive_message = MagicMock(side_effect=[
+            {'Messages': self.messages[0:10]}, {'Messages': self.messages[10:20]}, {'Messages': self.messages[20:25]},
+            {}
+        ])
+        self.events = []
+        self.writer.sqs_client.delete_message_batch.side_effect = lambda **kwargs: self.events.append(
+            ('ack', [entry['ReceiptHandle'] for entry in kwargs['Entries']])) or {'Successful': [], 'Failed': []}
+
+    def test_batches_are_acknowledged_after_commit(self):
+        db_conn = MagicMock()
+        db_conn.commit.side_effect = lambda: self.events.append(('commit', None))
+        with patch.object(persistent_database_writer.psycopg2, 'connect', return_value=db_conn), \
+                patch.object(persistent_database_writer.psycopg2.extras, 'execute_values'):
+            work_remaining = self.writer.drain_queue('nest-test-queue')
+
+        self.assertFalse(work_remaining)
+        self.assertEqual(db_conn.commit.call_count, 3)
+        acknowledged = [handle for event, handles in self.events if event == 'ack' for handle in handles]
+        self.assertEqual(sorted(acknowledged), sorted(m['ReceiptHandle'] for m in self.messages))
+        # Each acknowledgement follows the commit of its batch
+        for position, (event, handles) in enumerate(self.events):
+            if event == 'ack':
+                commits = [e for e, h in self.events[:position] if e == 'commit']
+                acks = [e for e, h in self.events[:position + 1] if e == 'ack']
+                self.assertLessEqual(len(acks), len(commits))
+
+    def test_failed_batch_is_not_acknowledged(self):
+        db_conn = MagicMock()
+        db_conn.commit.side_effect = [None, persistent_database_writer.psycopg2.OperationalError('connection lost')]
+        with patch.object(persistent_database_writer.psycopg2, 'connect', return_value=db_conn), \
+                patch.object(persistent_database_writer.psycopg2.extras, 'execute_values'):
+            with self.assertRaises(persistent_database_writer.psycopg2.OperationalError):
+                self.writer.drain_queue('nest-test-queue')
+
+        acknowledged = [handle for event, handles in self.events if event == 'ack' for handle in handles]
+        self.assertEqual(acknowledged, [m['ReceiptHandle'] for m in self.messages[0:10]])
@@ -2,8 +2,15 @@
 Lambda SMS Converter Test
 """
 
+import contextlib
+import json
 import unittest
+from unittest.mock import MagicMock, patch
 
+import botocore.exceptions
+import requests
+
+import lambdas.sms_submission_converter as sms_submission_converter
 from lambdas.sms_submission_converter import SmsSubmissionConverter
 
 test_payload = {
@@ -163,3 +170,289 @@ class SmsSubmissionConverterTest(unittest.TestCase):
       prepared_payload = self.converter.prepare_payload(self.event)
       form_definition = self.converter.get_form_definition(self.aggregate_url, self.form_id)
       xml_payload = self.converter.payload_json_to_xml(form_definition, prepared_payload)
+
+
+class FormDefinitionCacheTest(unittest.TestCase):
+    def setUp(self):
+        sms_submission_converter.form_definitions.clear()
+        self.converter = SmsSubmissionConverter()
+        self.aggregate_url = 'https://odk.test.org'
+        self.form_id = 'sms_test_form'
+
+    def tearDown(self):
+        sms_submission_converter.form_definitions.clear()
+
+    def create_response(self, status_code=200, text=xml_form_str.strip(), headers=None):
+        response = MagicMock(status_code=status_code, content=text.encode('utf-8'), headers=headers or {})
+        if status_code >= 400:
+            response.raise_for_status.side_effect = requests.HTTPError(str(status_code))
+        return response
+
+    @contextlib.contextmanager
+    def patch_get(self, **kwargs):
+        session = MagicMock(get=MagicMock(**kwargs))
+        with patch.dict(sms_submission_converter.http_sessions, {True: session, False: session}):
+            yield session
+
+    def expire(self):
+        for entry in sms_submission_converter.form_definitions.entries.values():
+            entry['validated_at'] -= sms_submission_converter.form_definitions.ttl
+
+    def test_definition_is_fetched_once(self):
+        with self.patch_get(return_value=self.create_response(headers={'ETag': '"v1"'})) as session:
+            first = self.converter.get_form_definition(self.aggregate_url, self.form_id)
+            second = self.converter.get_form_definition(self.aggregate_url, self.form_id)
+            ids_map = self.converter.get_ids_map(self.aggregate_url, self.form_id)
+
+        self.assertIs(first, second)
+        self.assertEqual(session.get.call_count, 1)
+        self.assertEqual(ids_map['did'], {'fieldName': 'deviceid', 'groupName': '', 'groupPath': []})
+        self.assertIs(ids_map, self.converter.get_ids_map(self.aggregate_url, self.form_id))
+
+    def test_expired_definition_is_revalidated(self):
+        with self.patch_get(side_effect=[
+            self.create_response(headers={'ETag': '"v1"', 'Last-Modified': 'Fri, 01 Mar 2019 09:39:02 GMT'}),
+            self.create_response(status_code=304, text='')
+        ]) as session:
+            first = self.converter.get_form_definition(self.aggregate_url, self.form_id)
+            self.expire()
+            second = self.converter.get_form_definition(self.aggregate_url, self.form_id)
+
+        self.assertIs(first, second)
+        self.assertEqual(session.get.call_args[1]['headers'], {'If-None-Match': '"v1"',
+                                                       'If-Modified-Since': 'Fri, 01 Mar 2019 09:39:02 GMT'})
+
+    def test_stale_definition_is_served_when_aggregate_fails(self):
+        with self.patch_get(side_effect=[
+            self.create_response(),
+            requests.Timeout('timed out'),
+            self.create_response(status_code=503)
+        ]):
+            first = self.converter.get_form_definition(self.aggregate_url, self.form_id)
+            self.expire()
+            self.assertIs(self.converter.get_form_definition(self.aggregate_url, self.form_id), first)
+            self.assertIs(self.converter.get_form_definition(self.aggregate_url, self.form_id), first)
+
+    def test_codec_of_stale_definition_is_built_with_one_request(self):
+        with self.patch_get(side_effect=[self.create_response(), requests.Timeout('timed out')]) as session:
+            self.converter.get_form_definition(self.aggregate_url, self.form_id)
+            self.expire()
+            codec = self.converter.get_form_codec(self.aggregate_url, self.form_id)
+
+        self.assertEqual(session.get.call_count, 2)
+        self.assertIn('did', codec.fields)
+        entry = sms_submission_converter.form_definitions.get((self.aggregate_url, self.form_id))
+        self.assertIs(entry['derived']['codec'], codec)
+
+    def test_failure_without_cached_definition_is_raised(self):
+        with self.patch_get(side_effect=requests.ConnectionError()):
+            with self.assertRaises(requests.ConnectionError):
+                self.converter.get_form_definition(self.aggregate_url, self.form_id)
+
+
+class FormCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.converter = SmsSubmissionConverter()
+        self.form_id = 'sms_test_form'
+        form_xml = xml_form_str.strip().replace(
+            '<meta>', '<visit><reason odk:tag="rs"/><place odk:tag="pl"/></visit><meta>')
+        self.form_definition = sms_submission_converter.xmltodict.parse(
+            form_xml, dict_constructor=sms_submission_converter.collections.OrderedDict)
+        self.codec = sms_submission_converter.FormCodec(
+            self.form_id, self.converter._short_to_long_field_names(self.form_definition, self.form_id))
+
+    def assert_compatible(self, prepared_payload):
+        self.assertEqual(self.codec.encode(prepared_payload),
+                         self.converter.payload_json_to_xml(self.form_definition, prepared_payload))
+
+    def test_output_matches_xml_string(self):
+        self.assert_compatible(self.converter.format_payload('sms_test_form;did;356123;yn;no;hm;123;'))
+
+    def test_groups_and_escaping(self):
+        prepared_payload = self.converter.format_payload(
+            'sms_test_form;rs;fever & <cough>;did;356123;pl;"home";yn;;hm;12')
+        self.assert_compatible(prepared_payload)
+        self.assertIn('<visit><reason>fever &amp; &lt;cough&gt;</reason><place>"home"</place></visit>',
+                      self.codec.encode(prepared_payload))
+
+    def test_empty_submission(self):
+        self.assert_compatible({'form_id': self.form_id, 'data': {}})
+
+    def test_unknown_tag_is_rejected(self):
+        with self.assertRaises(KeyError):
+            self.codec.encode({'form_id': self.form_id, 'data': {'xx': '1'}})
+
+
+class FormFieldExtractionTest(unittest.TestCase):
+    def setUp(self):
+        self.converter = SmsSubmissionConverter()
+        self.form_id = 'sms_test_form'
+
+    def test_same_fields_as_form_definition(self):
+        form_xml = xml_form_str.strip()
+        ids_map = self.converter._extract_ids_map(form_xml.encode('utf-8'))
+        legacy_ids_map = self.converter._short_to_long_field_names(
+            sms_submission_converter.xmltodict.parse(form_xml), self.form_id)
+
+        self.assertEqual({k: (v['fieldName'], v['groupName']) for k, v in ids_map.items()},
+                         {k: (v['fieldName'], v['groupName']) for k, v in legacy_ids_map.items()})
+
+    def test_nested_and_repeat_groups(self):
+        form_xml = xml_form_str.strip().replace('<meta>', """
+          <household odk:tag="hh">
+            <member jr:template="">
+              <person><age odk:tag="ag"/></person>
+              <sex odk:tag="sx"/>
+            </member>
+            <member>
+              <person><age odk:tag="ag"/></person>
+              <sex odk:tag="sx"/>
+            </member>
+          </household>
+          <meta>""").replace('<bind ', '<bind odk:tag="not_a_field" ', 1)
+        ids_map = self.converter._extract_ids_map(form_xml.encode('utf-8'))
+
+        self.assertEqual(ids_map['ag'], {'fieldName': 'age', 'groupName': 'person',
+                                         'groupPath': ['household', 'member', 'person']})
+        self.assertEqual(ids_map['sx']['groupPath'], ['household', 'member'])
+        self.assertEqual(ids_map['hh'], {'fieldName': 'household', 'groupName': '', 'groupPath': []})
+        self.assertNotIn('not_a_field', ids_map)
+
+        codec = sms_submission_converter.FormCodec(self.form_id, ids_map)
+        self.assertEqual(
+            codec.encode({'form_id': self.form_id, 'data': {'did': '1', 'ag': '30', 'sx': 'f'}}),
+            '<?xml version="1.0" encoding="utf-8"?>\n<sms_test_form id="sms_test_form"><deviceid>1</deviceid>'
+            '<household><member><person><age>30</age></person><sex>f</sex></member></household></sms_test_form>')
+
+
+class HttpSessionTest(unittest.TestCase):
+    def setUp(self):
+        sms_submission_converter.http_sessions.clear()
+        sms_submission_converter.form_definitions.clear()
+
+    def tearDown(self):
+        sms_submission_converter.http_sessions.clear()
+        sms_submission_converter.form_definitions.clear()
+
+    def test_session_is_shared(self):
+        session = sms_submission_converter.get_http_session()
+
+        self.assertIs(session, sms_submission_converter.get_http_session())
+        retry = session.get_adapter('https://odk.test.org').max_retries
+        self.assertEqual(retry.status_forcelist, (500, 502, 503, 504))
+        self.assertNotIn('POST', retry.allowed_methods)
+        self.assertEqual(retry.read, 0)
+        no_retry = sms_submission_converter.get_http_session(retry=False).get_adapter('https://odk.test.org')
+        self.assertEqual(no_retry.max_retries.total, 0)
+
+    def test_revalidation_is_sent_without_retries(self):
+        converter = SmsSubmissionConverter()
+        sms_submission_converter.form_definitions.set(('https://odk.test.org', 'sms_test_form'), b'<xml/>', etag='"v1"')
+        sms_submission_converter.form_definitions.entries[('https://odk.test.org', 'sms_test_form')][
+            'validated_at'] -= sms_submission_converter.form_definitions.ttl
+        retrying, single = MagicMock(), MagicMock()
+        single.get.return_value = MagicMock(status_code=304)
+        with patch.dict(sms_submission_converter.http_sessions, {True: retrying, False: single}):
+            converter.get_form_entry('https://odk.test.org', 'sms_test_form')
+
+        self.assertFalse(retrying.get.called)
+        self.assertEqual(single.get.call_args[1]['timeout'][1], 2)
+
+    def test_timeouts_fit_the_deadline(self):
+        deadline = sms_submission_converter.time.monotonic() + 6
+        connect_timeout, read_timeout = sms_submission_converter.get_http_timeout(deadline)
+
+        self.assertLessEqual(4 * (connect_timeout + read_timeout) + 0.3 + 0.6 + 1.2, 6)
+        self.assertLessEqual(sum(sms_submission_converter.get_http_timeout(deadline, retry=False)), 6)
+        # Only the connection of a POST is retried, its response is read once
+        post_connect_timeout, post_read_timeout = sms_submission_converter.get_http_timeout(deadline, method='POST')
+        self.assertLessEqual(4 * post_connect_timeout + post_read_timeout + 0.3 + 0.6 + 1.2, 6)
+        self.assertGreater(post_read_timeout, 3 * read_timeout)
+        with self.assertRaises(requests.Timeout):
+            sms_submission_converter.get_http_timeout(sms_submission_converter.time.monotonic() - 1)
+
+    def test_submission_uses_session_with_deadline(self):
+        session = MagicMock()
+        session.post.return_value = MagicMock(status_code=201)
+        converter = MagicMock()
+        converter.is_multi_sms_payload.return_value = False
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = 60000
+        with patch.dict(sms_submission_converter.http_sessions, {True: session}), \
+                patch.object(sms_submission_converter, 'SmsSubmissionConverter', return_value=converter), \
+                patch.dict(sms_submission_converter.os.environ, {'AGGREGATE_URL': 'https://odk.test.org'}):
+            sms_submission_converter.lambda_handler(test_payload, context)
+
+        self.assertEqual(session.post.call_args[0][0], 'https://odk.test.org/submission')
+        connect_timeout, read_timeout = session.post.call_args[1]['timeout']
+        # The submission is not retried once it was sent, so it gets the full read timeout
+        self.assertEqual(read_timeout, 10)
+        self.assertLessEqual(4 * connect_timeout + read_timeout + 0.3 + 0.6 + 1.2, 25)
+        self.assertLessEqual(converter.deadline, sms_submission_converter.time.monotonic() + 25)
+
+
+class MultiPartSmsTest(unittest.TestCase):
+    def setUp(self):
+        self.converter = SmsSubmissionConverter()
+        self.client = MagicMock()
+        self.item = {'ref': {'S': 'ref-1'}, 'total': {'N': '11'}, 'count': {'N': '0'}}
+        self.client.update_item.side_effect = self.update_item
+        self.get_client = patch.object(sms_submission_converter, 'get_client', return_value=self.client)
+        self.get_client.start()
+
+    def tearDown(self):
+        self.get_client.stop()
+
+    def update_item(self, **kwargs):
+        part = kwargs['ExpressionAttributeNames']['#part']
+        if part in self.item:
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+        self.item[part] = kwargs['ExpressionAttributeValues'][':text']
+        self.item['count'] = {'N': str(int(self.item['count']['N']) + 1)}
+        return {'Attributes': dict(self.item)}
+
+    def create_event(self, part, text, total=11):
+        return {'body': json.dumps({'concat': 'true', 'concat-ref': 'ref-1', 'concat-total': str(total),
+                                    'concat-part': str(part), 'text': text})}
+
+    def test_parts_are_joined_in_numeric_order(self):
+        for part in [3, 11, 1, 10, 2, 4, 5, 6, 7, 8]:
+            ref, total, _, is_complete = self.converter.store_multi_sms_payload(self.create_event(part, f'{part};'))
+            self.assertFalse(is_complete)
+        ref, total, _, is_complete = self.converter.store_multi_sms_payload(self.create_event(9, '9;'))
+
+        self.assertTrue(is_complete)
+        self.assertEqual(self.converter.get_complete_multi_sms_payload(ref), ''.join(f'{i};' for i in range(1, 12)))
+        self.assertEqual(self.client.update_item.call_count, 11)
+        self.assertEqual(self.client.update_item.call_args[1]['ReturnValues'], 'ALL_NEW')
+        self.assertFalse(self.client.put_item.called)
+        self.assertFalse(self.client.get_paginator.called)
+
+    def test_redelivered_part_does_not_complete_twice(self):
+        self.item['total'] = {'N': '2'}
+        self.converter.store_multi_sms_payload(self.create_event(1, 'a', total=2))
+        self.assertTrue(self.converter.store_multi_sms_payload(self.create_event(2, 'b', total=2))[3])
+
+        self.assertFalse(self.converter.store_multi_sms_payload(self.create_event(2, 'b', total=2))[3])
+
+    def test_parts_stored_by_earlier_versions_are_queried(self):
+        self.item.update({'total': {'N': '3'}, 'count': {'N': '2'}})
+        self.client.get_paginator.return_value.paginate.return_value = [
+            {'Items': [{'part': {'S': '2'}, 'text': {'S': 'b'}}]},
+            {'Items': [{'part': {'S': '1'}, 'text': {'S': 'a'}}]}
+        ]
+        ref, total, _, is_complete = self.converter.store_multi_sms_payload(self.create_event(3, 'c', total=3))
+
+        self.assertTrue(is_complete)
+        self.assertEqual(self.converter.get_complete_multi_sms_payload(ref), 'abc')
+        self.client.get_paginator.assert_called_once_with('query')
+
+    def test_parts_are_read_without_storing_the_last_part(self):
+        self.item.update({'total': {'N': '2'}, 'count': {'N': '2'}, 'part_2': {'S': 'b'}, 'part_1': {'S': 'a'}})
+        self.client.get_item.return_value = {'Item': self.item}
+
+        self.assertEqual(SmsSubmissionConverter().get_complete_multi_sms_payload('ref-1'), 'ab')
+        self.client.get_item.assert_called_once_with(TableName='SmsReceived', Key={'ref': {'S': 'ref-1'}},
+                                                     ConsistentRead=True)
+        self.assertFalse(self.client.get_paginator.called)